@@ -0,0 +1,217 @@
+"""
+Micro-benchmarks for the hot paths of Stream Sync, run them on a site with
+
+	bench --site <site> execute stream_sync.benchmarks.<function> --kwargs "{...}"
+"""
+
+import copy
+import timeit
+
+import frappe
+
+
+def report(label, seconds, number):
+	per_call = seconds / number * 1e6
+	print(f"{label}: {per_call:.2f} µs per call ({number} calls)")
+	return per_call
+
+
+def notify_consumers_overhead(doctype="ToDo", number=100000):
+	"""Cost the notify_consumers hook adds to every save of a doctype without Stream consumers"""
+	from stream_sync.stream_sync.doctype.stream_update_log.stream_update_log import (
+		check_doctype_has_consumers,
+		notify_consumers,
+	)
+
+	if check_doctype_has_consumers(doctype):
+		frappe.throw(f"{doctype} has Stream consumers, pick a doctype without any")
+
+	doc = frappe.new_doc(doctype)
+	baseline = timeit.timeit(lambda: None, number=number)
+	hook = timeit.timeit(lambda: notify_consumers(doc, "on_update"), number=number)
+
+	# every save in a fresh request, with the request-local cache emptied before each call
+	def fresh_request():
+		frappe.local.cache = {}
+		notify_consumers(doc, "on_update")
+
+	fresh_baseline = timeit.timeit(lambda: setattr(frappe.local, "cache", {}), number=number)
+	fresh = timeit.timeit(fresh_request, number=number)
+	return {
+		"baseline": report("empty call", baseline, number),
+		"notify_consumers": report(f"notify_consumers on {doctype}", hook, number),
+		"fresh_baseline": report("emptying the request cache", fresh_baseline, number),
+		"fresh_request": report(f"notify_consumers on {doctype} in fresh requests", fresh, number),
+	}
+
+
+def get_update_diff(doctype="Sales Invoice", name=None, number=20):
+	"""
+	Diff cost of get_update against the previous field-by-field implementation, on a saved document
+	whose copy gets a changed value in every other child row
+	"""
+	from stream_sync.stream_sync.doctype.stream_update_log.stream_update_log import get_update
+
+	name = name or frappe.get_all(doctype, order_by="creation desc", limit=1, pluck="name")[0]
+	old, new = frappe.get_doc(doctype, name), frappe.get_doc(doctype, name)
+	for df in new.meta.get_table_fields():
+		child_meta = frappe.get_meta(df.options)
+		field = next((f for f in child_meta.fields if f.fieldtype in ("Data", "Small Text", "Text")), None)
+		if not field:
+			continue
+		for row in new.get(df.fieldname)[::2]:
+			row.set(field.fieldname, f"{row.get(field.fieldname) or ''} changed")
+
+	if frappe.as_json(legacy_get_update(old, new)) != frappe.as_json(get_update(old, new)):
+		frappe.throw("get_update and the previous implementation disagree")
+
+	rows = sum(len(new.get(df.fieldname)) for df in new.meta.get_table_fields())
+	return {
+		"previous": report(
+			f"previous get_update ({rows} rows)",
+			timeit.timeit(lambda: legacy_get_update(old, new), number=number),
+			number,
+		),
+		"get_update": report(
+			f"get_update ({rows} rows)", timeit.timeit(lambda: get_update(old, new), number=number), number
+		),
+	}
+
+
+def legacy_get_update(old, new, for_child=False):
+	"""get_update as it was before the per-doctype diff plans, kept as the benchmark reference"""
+	from frappe.model import no_value_fields, table_fields
+
+	out = frappe._dict(changed={}, added={}, removed={}, row_changed={})
+	for df in new.meta.fields:
+		if df.fieldtype in no_value_fields and df.fieldtype not in table_fields:
+			continue
+
+		old_value, new_value = old.get(df.fieldname), new.get(df.fieldname)
+		if df.fieldtype in table_fields:
+			old_row_by_name = {d.name: d for d in old_value}
+			new_row_by_name = {d.name: d for d in new_value}
+			for d in new_value:
+				if d.name in old_row_by_name:
+					diff = legacy_get_update(old_row_by_name[d.name], d, for_child=True)
+					if diff and diff.changed:
+						diff.changed["name"] = d.name
+						out.row_changed.setdefault(df.fieldname, []).append(diff.changed)
+				else:
+					out.added.setdefault(df.fieldname, []).append(d.as_dict())
+			for d in old_value:
+				if d.name not in new_row_by_name:
+					out.removed.setdefault(df.fieldname, []).append(d.name)
+		elif old_value != new_value:
+			out.changed[df.fieldname] = new_value
+
+	if not for_child and old.docstatus != new.docstatus:
+		out.changed["docstatus"] = new.docstatus
+	if any((out.changed, out.added, out.removed, out.row_changed)):
+		return out
+	return None
+
+
+def mapping_cost(mapping, rows=20, number=1000):
+	"""
+	Cost of mapping a Create and an Update through the compiled plan of a Doctype Mapping,
+	on a sample document with every mapped field set and `rows` rows per mapped child table;
+	Document type fields are left out as they fetch from the producer
+	"""
+	from stream_sync.stream_sync.doctype.doctype_mapping.doctype_mapping import get_mapping_plan
+
+	plan = get_mapping_plan(mapping)
+	doc = get_sample_doc(plan, rows)
+	changed = {fieldname: value for fieldname, value in doc.items() if not isinstance(value, list)}
+
+	copy_doc = timeit.timeit(lambda: copy.deepcopy(doc), number=number)
+	create = timeit.timeit(
+		lambda: plan.map_doc(frappe._dict(copy.deepcopy(doc)), None, "Create"), number=number
+	)
+	update = timeit.timeit(lambda: plan.map_update({"changed": dict(changed)}, None), number=number)
+	return {
+		"copy": report("copying the sample document", copy_doc, number),
+		"create": report(f"mapping a Create with {mapping} (copy included)", create, number),
+		"update": report(f"mapping an Update with {mapping}", update, number),
+	}
+
+
+def get_sample_doc(plan, rows, child=False):
+	doc = frappe._dict(doctype=plan.remote_doctype, name="benchmark")
+	for field in plan.fields:
+		if field.mapping_type == "Document":
+			continue
+		if field.mapping_type == "Child Table":
+			if field.inner and not child:
+				doc[field.remote_fieldname] = [
+					get_sample_doc(field.inner, rows, child=True) for _i in range(rows)
+				]
+			continue
+		doc[field.remote_fieldname] = f"{field.remote_fieldname} value"
+	return doc
+
+
+def update_apply(doctype="Sales Invoice", name=None, fieldname="remarks", number=5):
+	"""
+	Cost of applying an Update that changes one parent field and one child row, through save() and
+	db_update_all() as set_update does against the column level path; by default on the document with
+	the most rows in its first table, e.g. one with 200 items. Every apply is rolled back
+	"""
+	from stream_sync.stream_sync.doctype.stream_producer.stream_producer import (
+		ChildRowChanges,
+		write_update_columns,
+	)
+
+	table = frappe.get_meta(doctype).get_table_fields()[0]
+	name = (
+		name
+		or frappe.db.sql(
+			f"""select parent from `tab{table.options}` where parenttype = %s
+		group by parent order by count(*) desc limit 1""",
+			doctype,
+		)[0][0]
+	)
+	doc = frappe.get_doc(doctype, name)
+	row = doc.get(table.fieldname)[0]
+	child_field = next(
+		f for f in frappe.get_meta(table.options).fields if f.fieldtype in ("Data", "Small Text", "Text")
+	)
+	data = frappe._dict(
+		changed={fieldname: "benchmark"},
+		row_changed={table.fieldname: [{"name": row.name, child_field.fieldname: "benchmark"}]},
+	)
+
+	def save():
+		local_doc = frappe.get_doc(doctype, name)
+		local_doc.update(data.changed)
+		rows = ChildRowChanges.from_doc(local_doc)
+		rows.add_diff(data)
+		rows.apply_to(local_doc)
+		local_doc.flags.ignore_validate = True
+		local_doc.flags.ignore_version = True
+		local_doc.flags.ignore_permission = True
+		rows.insert()
+		local_doc.save()
+		local_doc.db_update_all()
+
+	def columns():
+		write_update_columns(doctype, frappe._dict(name=name, docstatus=doc.docstatus), data)
+
+	def rolled_back(apply):
+		frappe.db.savepoint("stream_sync_benchmark")
+		apply()
+		frappe.db.rollback(save_point="stream_sync_benchmark")
+
+	rows = len(doc.get(table.fieldname))
+	return {
+		"save": report(
+			f"save and db_update_all ({rows} rows)",
+			timeit.timeit(lambda: rolled_back(save), number=number),
+			number,
+		),
+		"columns": report(
+			f"column level apply ({rows} rows)",
+			timeit.timeit(lambda: rolled_back(columns), number=number),
+			number,
+		),
+	}
@@ -167,6 +167,13 @@ doc_events = {
 # 	],
 # }
 
+scheduler_events = {
+    "daily_long": [
+        "stream_sync.stream_sync.doctype.stream_update_log.stream_update_log.purge_update_logs",
+        "stream_sync.stream_sync.doctype.stream_sync_log.stream_sync_log.purge_sync_logs"
+    ]
+}
+
 # Testing
 # -------
 
@@ -0,0 +1,15 @@
+import frappe
+
+from stream_sync.stream_sync.doctype.stream_producer.stream_producer import add_remote_name_index
+
+
+def execute():
+	"""Index remote_site_name and remote_docname of the doctypes consumed under their own names"""
+	doctypes = frappe.get_all(
+		"Stream Producer Doctype", filters={"use_same_name": 0}, pluck="ref_doctype", distinct=True
+	)
+	for doctype in doctypes:
+		if frappe.db.has_column(doctype, "remote_site_name") and frappe.db.has_column(
+			doctype, "remote_docname"
+		):
+			add_remote_name_index(doctype)
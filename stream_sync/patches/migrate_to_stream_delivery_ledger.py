@@ -0,0 +1,23 @@
+import frappe
+
+from stream_sync.stream_sync.doctype.stream_delivery_ledger.stream_delivery_ledger import mark_delivered
+
+
+def execute():
+	"""Build the Stream Delivery Ledger from the per-log Stream Update Log Consumer rows, then drop them"""
+	if frappe.db.table_exists("Stream Update Log Consumer"):
+		consumers = frappe.db.sql_list("SELECT DISTINCT consumer FROM `tabStream Update Log Consumer`")
+		for consumer in consumers:
+			update_logs = frappe.db.sql(
+				"""
+				SELECT update_log.name, update_log.ref_doctype, update_log.docname, update_log.creation
+				FROM `tabStream Update Log` update_log
+				JOIN `tabStream Update Log Consumer` log_consumer ON log_consumer.parent = update_log.name
+				WHERE log_consumer.consumer = %s
+			""",
+				consumer,
+				as_dict=True,
+			)
+			mark_delivered(consumer, update_logs)
+
+	frappe.delete_doc("DocType", "Stream Update Log Consumer", ignore_missing=True, force=True)
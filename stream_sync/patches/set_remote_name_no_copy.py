@@ -0,0 +1,14 @@
+import frappe
+
+
+def execute():
+	"""Stop amends and duplicates from copying the remote name of a synced document"""
+	fields = frappe.get_all(
+		"Custom Field",
+		filters={"fieldname": ("in", ["remote_docname", "remote_site_name"]), "no_copy": 0},
+		fields=["name", "dt"],
+	)
+	for field in fields:
+		frappe.db.set_value("Custom Field", field.name, "no_copy", 1, update_modified=False)
+	for doctype in {field.dt for field in fields}:
+		frappe.clear_cache(doctype=doctype)
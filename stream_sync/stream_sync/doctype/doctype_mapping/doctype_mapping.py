@@ -8,6 +8,8 @@ from frappe import _
 from frappe.model import child_table_fields, default_fields
 from frappe.model.document import Document
 
+from stream_sync.utils import bump_cache_version, get_cache_version, get_remote_docs
+
 
 class DoctypeMapping(Document):
 	def validate(self):
@@ -35,164 +37,193 @@ class DoctypeMapping(Document):
 				).format(field_map.idx, frappe.bold(field_map.remote_fieldname))
 				frappe.throw(msg, title="Remote Value Filters Missing")
 
+	def on_update(self):
+		bump_mapping_plans()
+
+	def on_trash(self):
+		bump_mapping_plans()
+
 	def get_mapping(self, doc, producer_site, update_type):
+		doc, dependencies = get_mapping_plan(self.name).map_doc(doc, producer_site, update_type)
+		mapping = {"doc": frappe.as_json(doc)}
+		if len(dependencies):
+			mapping["dependencies"] = [
+				(fieldname, frappe.as_json(dependency)) for fieldname, dependency in dependencies
+			]
+		return mapping
+
+	def get_mapped_update(self, update, producer_site):
+		diff, dependencies = get_mapping_plan(self.name).map_update(
+			frappe.parse_json(update.data), producer_site
+		)
+		update = {"doc": frappe.as_json(diff)}
+		if len(dependencies):
+			update["dependencies"] = [
+				(fieldname, frappe.as_json(dependency)) for fieldname, dependency in dependencies
+			]
+		return update
+
+
+MAPPING_PLANS_VERSION_KEY = "stream_sync_mapping_plans_version"
+
+# compiled MappingPlans keyed by (site, mapping name), see get_mapping_plan
+mapping_plans = {}
+
+
+def get_mapping_plan(name):
+	"""MappingPlan of the Doctype Mapping, compiled once per process until a Doctype Mapping is saved"""
+	version = get_cache_version(MAPPING_PLANS_VERSION_KEY)
+	key = (frappe.local.site, name)
+	cached = mapping_plans.get(key)
+	if not cached or cached[0] != version:
+		cached = mapping_plans[key] = (version, MappingPlan(frappe.get_doc("Doctype Mapping", name)))
+	return cached[1]
+
+
+def bump_mapping_plans():
+	# plans embed the plans of their inner mappings, rebuild them all
+	bump_cache_version(MAPPING_PLANS_VERSION_KEY)
+	frappe.db.after_commit.add(lambda: bump_cache_version(MAPPING_PLANS_VERSION_KEY))
+
+
+class MappingPlan:
+	"""
+	A Doctype Mapping compiled for mapping producer documents and diffs in place as dicts
+	The mappings it refers to for child tables and dependency documents are compiled along with it
+	"""
+
+	def __init__(self, mapping, compiling=None):
+		compiling = compiling if compiling is not None else {}
+		compiling[mapping.name] = self
+
+		self.name = mapping.name
+		self.local_doctype = mapping.local_doctype
+		self.remote_doctype = mapping.remote_doctype
+		self.fields = []
+		# remote table fieldname -> (local table fieldname, plan of its rows)
+		self.tables = {}
+		for row in mapping.field_mapping:
+			inner = None
+			if row.mapping:
+				inner = compiling.get(row.mapping) or MappingPlan(
+					frappe.get_doc("Doctype Mapping", row.mapping), compiling
+				)
+			self.fields.append(
+				frappe._dict(
+					remote_fieldname=row.remote_fieldname,
+					local_fieldname=row.local_fieldname,
+					mapping_type=row.mapping_type,
+					default_value=row.default_value,
+					is_empty=row.is_empty,
+					inner=inner,
+					remote_value_filters=json.loads(row.remote_value_filters)
+					if row.mapping_type == "Document" and row.remote_value_filters
+					else None,
+				)
+			)
+			if row.remote_fieldname not in self.tables:
+				self.tables[row.remote_fieldname] = (row.local_fieldname, inner)
+
+	def map_doc(self, doc, producer_site, update_type):
+		"""Map a document, or the changed values of an Update, returns it with its (local_fieldname, doc) dependencies"""
 		remote_fields = []
-		# list of tuples (local_fieldname, dependent_doc)
 		dependencies = []
 
-		for mapping in self.field_mapping:
-			if doc.get(mapping.remote_fieldname):
-				if mapping.mapping_type == "Document":
-					if not mapping.default_value:
-						dependency = self.get_mapped_dependency(mapping, producer_site, doc)
+		for field in self.fields:
+			if doc.get(field.remote_fieldname):
+				if field.mapping_type == "Document":
+					if not field.default_value:
+						dependency = self.get_dependency(field, producer_site, doc)
 						if dependency:
-							dependencies.append((mapping.local_fieldname, dependency))
+							dependencies.append((field.local_fieldname, dependency))
 					else:
-						doc[mapping.local_fieldname] = mapping.default_value
+						doc[field.local_fieldname] = field.default_value
 
-				if mapping.mapping_type == "Child Table" and update_type != "Update":
-					doc[mapping.local_fieldname] = get_mapped_child_table_docs(
-						mapping.mapping, doc[mapping.remote_fieldname], producer_site
+				if field.mapping_type == "Child Table" and update_type != "Update":
+					doc[field.local_fieldname] = (
+						field.inner.map_rows(doc[field.remote_fieldname]) if field.inner else []
 					)
 				else:
 					# copy value into local fieldname key and remove remote fieldname key
-					if mapping.is_empty:
-						doc[mapping.local_fieldname] = None
-					elif mapping.default_value:
-						doc[mapping.local_fieldname] = mapping.default_value
-					else:	
-						doc[mapping.local_fieldname] = doc[mapping.remote_fieldname]
+					if field.is_empty:
+						doc[field.local_fieldname] = None
+					elif field.default_value:
+						doc[field.local_fieldname] = field.default_value
+					else:
+						doc[field.local_fieldname] = doc[field.remote_fieldname]
 
-				if mapping.local_fieldname != mapping.remote_fieldname:
-					remote_fields.append(mapping.remote_fieldname)
+				if field.local_fieldname != field.remote_fieldname:
+					remote_fields.append(field.remote_fieldname)
 
-			if not doc.get(mapping.remote_fieldname) and mapping.default_value and update_type != "Update":
-				doc[mapping.local_fieldname] = mapping.default_value
+			if not doc.get(field.remote_fieldname) and field.default_value and update_type != "Update":
+				doc[field.local_fieldname] = field.default_value
 
 		# remove the remote fieldnames
-		for field in remote_fields:
-			doc.pop(field, None)
+		for fieldname in remote_fields:
+			doc.pop(fieldname, None)
 
 		if update_type != "Update":
 			doc["doctype"] = self.local_doctype
 
-		mapping = {"doc": frappe.as_json(doc)}
-		if len(dependencies):
-			mapping["dependencies"] = dependencies
-		return mapping
+		return doc, dependencies
+
+	def map_rows(self, rows):
+		"""Map the rows of a child table of a new document"""
+		for row in rows:
+			for field in self.fields:
+				if row.get(field.remote_fieldname):
+					if field.default_value:
+						row[field.local_fieldname] = field.default_value
+					elif field.is_empty:
+						row[field.local_fieldname] = None
+					else:
+						row[field.local_fieldname] = row[field.remote_fieldname]
 
-	def get_mapped_update(self, update, producer_site):
-		update_diff = frappe._dict(json.loads(update.data))
-		mapping = update_diff
-		dependencies = []
-		if update_diff.changed:
-			doc_map = self.get_mapping(update_diff.changed, producer_site, "Update")
-			mapped_doc = doc_map.get("doc")
-			mapping.changed = json.loads(mapped_doc)
-			if doc_map.get("dependencies"):
-				dependencies += doc_map.get("dependencies")
-
-		if update_diff.removed:
-			mapping = self.map_rows_removed(update_diff, mapping)
-		if update_diff.added:
-			mapping = self.map_rows(update_diff, mapping, producer_site, operation="added")
-		if update_diff.row_changed:
-			mapping = self.map_rows(update_diff, mapping, producer_site, operation="row_changed")
-
-		update = {"doc": frappe.as_json(mapping)}
-		if len(dependencies):
-			update["dependencies"] = dependencies
-		return update
+					if field.local_fieldname != field.remote_fieldname:
+						row.pop(field.remote_fieldname, None)
+			row["doctype"] = self.local_doctype
+		return rows
 
-	def get_mapped_dependency(self, mapping, producer_site, doc):
-		inner_mapping = frappe.get_doc("Doctype Mapping", mapping.mapping)
-		filters = json.loads(mapping.remote_value_filters)
+	def map_update(self, diff, producer_site):
+		"""Map the diff of an Update, returns it with its (local_fieldname, doc) dependencies"""
+		diff = frappe._dict(diff)
+		dependencies = []
+		if diff.changed:
+			diff.changed, dependencies = self.map_doc(diff.changed, producer_site, "Update")
+
+		if diff.removed:
+			diff.removed = {
+				self.tables[tablename][0]: rownames
+				for tablename, rownames in diff.removed.items()
+				if self.tables.get(tablename, (None,))[0]
+			}
+		for operation in ("added", "row_changed"):
+			if not diff.get(operation):
+				continue
+			mapped = {}
+			for tablename, entries in diff.get(operation).items():
+				local_tablename, inner = self.tables.get(tablename, (None, None))
+				if not inner:
+					mapped[tablename] = entries
+					continue
+				mapped[local_tablename] = [
+					inner.map_doc(entry, producer_site, "Update")[0] for entry in entries
+				]
+			diff[operation] = mapped
+
+		return diff, dependencies
+
+	def get_dependency(self, field, producer_site, doc):
+		filters = dict(field.remote_value_filters)
 		for key, value in filters.items():
 			if value.startswith("eval:"):
 				val = frappe.safe_eval(value[5:], None, dict(doc=doc))
 				filters[key] = val
 			if doc.get(value):
 				filters[key] = doc.get(value)
-		matching_docs = producer_site.get_doc(inner_mapping.remote_doctype, filters=filters)
-		if len(matching_docs):
-			remote_docname = matching_docs[0].get("name")
-			remote_doc = producer_site.get_doc(inner_mapping.remote_doctype, remote_docname)
-			doc = inner_mapping.get_mapping(remote_doc, producer_site, "Insert").get("doc")
-			return doc
-		return
-
-	def map_rows_removed(self, update_diff, mapping):
-		removed = []
-		mapping["removed"] = update_diff.removed
-		for key, value in update_diff.removed.copy().items():
-			local_table_name = frappe.db.get_value(
-				"Doctype Field Mapping",
-				{"remote_fieldname": key, "parent": self.name},
-				"local_fieldname",
-			)
-			mapping.removed[local_table_name] = value
-			if local_table_name != key:
-				removed.append(key)
-
-		# remove the remote fieldnames
-		for field in removed:
-			mapping.removed.pop(field, None)
-		return mapping
-
-	def map_rows(self, update_diff, mapping, producer_site, operation):
-		remote_fields = []
-		for tablename, entries in update_diff.get(operation).copy().items():
-			local_table_name = frappe.db.get_value(
-				"Doctype Field Mapping", {"remote_fieldname": tablename}, "local_fieldname"
-			)
-			table_map = frappe.db.get_value(
-				"Doctype Field Mapping",
-				{"local_fieldname": local_table_name, "parent": self.name},
-				"mapping",
-			)
-			if not table_map:
-				continue
-			table_map = frappe.get_doc("Doctype Mapping", table_map)
-			docs = []
-			for entry in entries:
-				mapped_doc = table_map.get_mapping(entry, producer_site, "Update").get("doc")
-				docs.append(json.loads(mapped_doc))
-			mapping.get(operation)[local_table_name] = docs
-			if local_table_name != tablename:
-				remote_fields.append(tablename)
-
-		# remove the remote fieldnames
-		for field in remote_fields:
-			mapping.get(operation).pop(field, None)
-
-		return mapping
-
-
-def get_mapped_child_table_docs(child_map, table_entries, producer_site):
-	"""Get mapping for child doctypes"""
-	if not child_map:
-		return []
-	child_map = frappe.get_doc("Doctype Mapping", child_map)
-	mapped_entries = []
-	remote_fields = []
-	for child_doc in table_entries:
-		for mapping in child_map.field_mapping:
-			if child_doc.get(mapping.remote_fieldname):
-				if mapping.default_value:
-					child_doc[mapping.local_fieldname] = mapping.default_value
-				elif mapping.is_empty:
-					child_doc[mapping.local_fieldname] = None
-				else:
-					child_doc[mapping.local_fieldname] = child_doc[mapping.remote_fieldname]
-
-				if mapping.local_fieldname != mapping.remote_fieldname:
-					child_doc.pop(mapping.remote_fieldname, None)
-		# frappe.throw(child_doc)
-		mapped_entries.append(child_doc)
-
-	# remove the remote fieldnames
-	for field in remote_fields:
-		child_doc.pop(field, None)
-
-	child_doc["doctype"] = child_map.local_doctype
-	return mapped_entries
+		# the first match and its whole document in one call
+		remote_doc = get_remote_docs(
+			producer_site, [{"doctype": field.inner.remote_doctype, "filters": filters, "first": 1}]
+		)[0]
+		if remote_doc:
+			return field.inner.map_doc(remote_doc, producer_site, "Insert")[0]
@@ -2,15 +2,32 @@
 # For license information, please see license.txt
 import json
 import os
+import re
 
 import requests
 
 import frappe
 from frappe import _
+from frappe.model import default_fields, no_value_fields
 from frappe.utils.data import get_link_to_form, get_url
 from frappe.model.document import Document
-from frappe.frappeclient import FrappeClient
-from frappe.utils.background_jobs import get_jobs
+
+from stream_sync.stream_sync.doctype.stream_delivery_ledger.stream_delivery_ledger import (
+	get_delivery_watermarks,
+)
+from stream_sync.utils import (
+	REMOTE_CLIENTS_VERSION_KEY,
+	bump_cache_version,
+	debounce,
+	get_remote_client,
+	release_debounce,
+)
+
+# documents get_docs answers per call
+MAX_DOC_REQUESTS = 500
+
+# how long a queued notification retry blocks further retries for the same consumer
+NOTIFY_RETRY_DEBOUNCE_TTL = 300
 
 
 class StreamConsumer(Document):
@@ -33,15 +50,18 @@ class StreamConsumer(Document):
 
 	def clear_cache(self):
 		from stream_sync.stream_sync.doctype.stream_update_log.stream_update_log import (
-			ENABLED_DOCTYPES_CACHE_KEY,
+			clear_subscribed_doctypes,
 		)
 
-		frappe.cache().delete_value(ENABLED_DOCTYPES_CACHE_KEY)
+		clear_subscribed_doctypes()
+		bump_cache_version(REMOTE_CLIENTS_VERSION_KEY)
+		# again once committed, in case another process reloaded its cache before that
+		frappe.db.after_commit.add(clear_subscribed_doctypes)
+		frappe.db.after_commit.add(lambda: bump_cache_version(REMOTE_CLIENTS_VERSION_KEY))
 		return super().clear_cache()
 
 	def on_trash(self):
-		for i in frappe.get_all("Stream Update Log Consumer", {"consumer": self.name}):
-			frappe.delete_doc("Stream Update Log Consumer", i.name)
+		frappe.db.delete("Stream Delivery Ledger", {"consumer": self.name})
 
 	def update_consumer_status(self):
 		consumer_site = get_consumer_site(self.callback_url)
@@ -121,15 +141,54 @@ def register_consumer(data):
 	return json.dumps({"last_update": last_update})
 
 
+@frappe.whitelist()
+def get_docs(requests):
+	"""
+	Answer many document requests in one call, results come back in request order
+	- {"doctype", "name"}: the whole document, None if it does not exist or can not be read
+	- {"doctype", "filters", "first": 1}: the whole first matching document or None
+	- {"doctype", "filters", "fields", "limit"}: the list of matching rows, like /api/resource
+	"""
+	requests = frappe.parse_json(requests)
+	if len(requests) > MAX_DOC_REQUESTS:
+		frappe.throw(_("At most {0} documents can be requested at once").format(MAX_DOC_REQUESTS))
+
+	results = []
+	for request in requests:
+		request = frappe._dict(request)
+		if request.name or request.first:
+			results.append(get_readable_doc(request.doctype, request.name, request.filters))
+		else:
+			results.append(
+				frappe.get_list(
+					request.doctype,
+					filters=request.filters,
+					fields=request.fields or ["name"],
+					limit_page_length=request.limit or 20,
+				)
+			)
+	return results
+
+
+def get_readable_doc(doctype, name=None, filters=None):
+	if not name:
+		names = frappe.get_list(doctype, filters=filters, pluck="name", limit_page_length=1)
+		if not names:
+			return None
+		name = names[0]
+
+	if not frappe.db.exists(doctype, name):
+		return None
+	doc = frappe.get_doc(doctype, name)
+	if not frappe.has_permission(doctype, "read", doc):
+		return None
+	doc.apply_fieldlevel_read_permissions()
+	return doc.as_dict()
+
+
 def get_consumer_site(consumer_url):
-	"""create a FrappeClient object for Stream consumer site"""
-	consumer_doc = frappe.get_doc("Stream Consumer", consumer_url)
-	consumer_site = FrappeClient(
-		url=consumer_url,
-		api_key=consumer_doc.api_key,
-		api_secret=consumer_doc.get_password("api_secret"),
-	)
-	return consumer_site
+	"""get the shared FrappeClient object for Stream consumer site"""
+	return get_remote_client("Stream Consumer", consumer_url)
 
 
 def get_last_update():
@@ -145,6 +204,13 @@ def get_last_update():
 @frappe.whitelist()
 def notify_stream_consumers(doctype):
 	"""get all Stream consumers and set flag for notification status"""
+	from stream_sync.stream_sync.doctype.stream_update_log.stream_update_log import (
+		get_notify_debounce_key,
+	)
+
+	# logs inserted from now on need a new notification
+	release_debounce(get_notify_debounce_key(doctype))
+
 	stream_consumers = frappe.get_all(
 		"Stream Consumer Doctype", ["parent"], {"ref_doctype": doctype, "status": "Actived"}
 	)
@@ -157,6 +223,7 @@ def notify_stream_consumers(doctype):
 @frappe.whitelist()
 def notify(consumer):
 	"""notify individual Stream consumers about a new update"""
+	release_debounce(f"stream_sync_notify_retry:{consumer.name}")
 	consumer_status = consumer.get_consumer_status()
 	if consumer_status == "online":
 		try:
@@ -176,8 +243,7 @@ def notify(consumer):
 	# enqueue another job if the site was not notified
 	if not consumer.flags.notified:
 		enqueued_method = "stream_sync.stream_sync.doctype.stream_consumer.stream_consumer.notify"
-		jobs = get_jobs()
-		if not jobs or enqueued_method not in jobs[frappe.local.site] and not consumer.flags.notifed:
+		if debounce(f"stream_sync_notify_retry:{consumer.name}", NOTIFY_RETRY_DEBOUNCE_TTL):
 			frappe.enqueue(
 				enqueued_method, queue="long", enqueue_after_commit=True, **{"consumer": consumer}
 			)
@@ -185,45 +251,204 @@ def notify(consumer):
 
 def has_consumer_access(consumer, update_log):
 	"""Checks if consumer has completely satisfied all the conditions on the doc"""
+	return get_consumer_access(consumer, [update_log])[0]
 
+
+def get_consumer_access(consumer, update_logs):
+	"""
+	Checks consumer access for a whole page of update logs at once
+	Existence is checked with one query per doctype, and the referenced documents are loaded in bulk
+	with only the fields their condition reads
+	:return: list of booleans, one per update log
+	"""
 	if isinstance(consumer, str):
 		consumer = frappe.get_doc("Stream Consumer", consumer)
 
-	if not frappe.db.exists(update_log.ref_doctype, update_log.docname):
+	config = get_consumer_config(consumer)
+
+	logs_by_doctype = {}
+	for update_log in update_logs:
+		logs_by_doctype.setdefault(update_log.ref_doctype, []).append(update_log)
+
+	access = {}
+	for ref_doctype, logs in logs_by_doctype.items():
+		docnames = list({d.docname for d in logs})
+		existing = set(frappe.get_all(ref_doctype, filters={"name": ("in", docnames)}, pluck="name"))
+
 		# Delete Log
-		# Check if the last Update Log of this document was read by this consumer
-		last_update_log = frappe.get_all(
-			"Stream Update Log",
-			filters={
-				"ref_doctype": update_log.ref_doctype,
-				"docname": update_log.docname,
-				"creation": ["<", update_log.creation],
-			},
-			order_by="creation desc",
-			limit_page_length=1,
-		)
-		if not len(last_update_log):
+		# Check if the document was ever delivered to this consumer
+		deleted = [(ref_doctype, d.docname) for d in logs if d.docname not in existing]
+		delivered = get_delivery_watermarks(consumer.name, deleted) if deleted else {}
+
+		dt_entry = config.get(ref_doctype)
+		compiled = compile_condition(dt_entry.condition) if dt_entry else None
+		visible, docs, results = None, {}, {}
+		if compiled and is_sql_condition(ref_doctype, compiled):
+			# pre-selected by the database, then confirmed below
+			visible = set()
+			if existing:
+				visible = set(
+					frappe.get_all(
+						ref_doctype,
+						filters=[["name", "in", list(existing)], *[list(f) for f in compiled.filters]],
+						or_filters=[list(f) for f in compiled.or_filters],
+						pluck="name",
+					)
+				)
+			docs = get_condition_docs(ref_doctype, visible, compiled)
+		elif compiled and compiled.condition:
+			docs = get_condition_docs(ref_doctype, existing, compiled)
+
+		for update_log in logs:
+			if update_log.docname not in existing:
+				allowed = (ref_doctype, update_log.docname) in delivered
+			elif not dt_entry:
+				allowed = False
+			elif not compiled.condition:
+				allowed = True
+			elif visible is not None and update_log.docname not in visible:
+				allowed = False
+			elif compiled.cmd:
+				# cmd conditions get the update log as well, evaluate each one
+				allowed = evaluate_condition(consumer, compiled, docs[update_log.docname], update_log)
+			else:
+				if update_log.docname not in results:
+					results[update_log.docname] = evaluate_condition(
+						consumer, compiled, docs[update_log.docname], update_log
+					)
+				allowed = results[update_log.docname]
+
+			access[id(update_log)] = bool(allowed)
+
+	return [access[id(update_log)] for update_log in update_logs]
+
+
+def get_consumer_config(consumer):
+	"""Stream Consumer Doctype entry of each doctype, the first one wins"""
+	config = {}
+	for dt_entry in consumer.consumer_doctypes:
+		config.setdefault(dt_entry.ref_doctype, dt_entry)
+	return config
+
+
+def get_sql_conditions(consumer, doctypes):
+	"""
+	Compiled conditions of the consumer's doctypes that can be evaluated in SQL
+	:return: dict of doctype -> compiled condition
+	"""
+	config = get_consumer_config(consumer)
+	sql_conditions = {}
+	for doctype in doctypes:
+		dt_entry = config.get(doctype)
+		if not dt_entry:
+			continue
+		compiled = compile_condition(dt_entry.condition)
+		if is_sql_condition(doctype, compiled):
+			sql_conditions[doctype] = compiled
+	return sql_conditions
+
+
+# consumer conditions compiled once per process, keyed by the condition text
+compiled_conditions = {}
+
+# fieldtypes compared the same way by Python and the database
+NUMERIC_FIELDTYPES = ("Int", "Float", "Currency", "Percent", "Check")
+
+SIMPLE_CONDITION_PART = re.compile(r"""^doc\.(\w+)\s*(==|!=|>=|<=|>|<)\s*("[^"]*"|'[^']*'|\d+)$""")
+
+
+def compile_condition(condition):
+	"""
+	Parse a Stream Consumer Doctype condition once per process
+	Expressions record the doc fields they read, and when they only compare fields with literals,
+	joined either by `and` or by `or`, also get filters the database can pre-select documents with,
+	see is_sql_condition
+	"""
+	condition = (condition or "").strip()
+	if condition in compiled_conditions:
+		return compiled_conditions[condition]
+
+	compiled = frappe._dict(
+		condition=condition,
+		cmd=None,
+		method=None,
+		fieldnames=frozenset(),
+		filters=None,
+		or_filters=None,
+		comparisons=(),
+	)
+	if condition.startswith("cmd:"):
+		compiled.cmd = condition.split("cmd:")[1].strip()
+	elif condition:
+		compiled.fieldnames = frozenset(re.findall(r"\bdoc\.(\w+)", condition))
+
+		parts = re.split(r"\s+(?:and|or)\s+", condition, flags=re.IGNORECASE)
+		connectors = {c.lower() for c in re.findall(r"\s+(and|or)\s+", condition, flags=re.IGNORECASE)}
+		matches = [SIMPLE_CONDITION_PART.match(part.strip()) for part in parts]
+		if len(connectors) <= 1 and condition.count("doc.") == len(parts) and all(matches):
+			from stream_sync.stream_sync.doctype.sync_hub.sync_hub import parse_condition
+
+			compiled.filters, compiled.or_filters = parse_condition(condition)
+			# (fieldname, operator, whether the literal is a string)
+			compiled.comparisons = tuple((m.group(1), m.group(2), m.group(3)[0] in "\"'") for m in matches)
+
+	compiled_conditions[condition] = compiled
+	return compiled
+
+
+def is_sql_condition(ref_doctype, compiled):
+	"""
+	Check if the filters of the compiled condition select at least every document it accepts,
+	so the database can pre-select documents and only those are evaluated
+	The filters are no exact equivalent: the column collation is case insensitive and quoted numbers
+	are compared as numbers. They still never reject a match for `==`, and for any operator
+	comparing a numeric field with a number
+	"""
+	if not (compiled.filters or compiled.or_filters):
+		return False
+	if not compiled.fieldnames <= get_columns(ref_doctype):
+		return False
+
+	meta = frappe.get_meta(ref_doctype)
+	for fieldname, operator, quoted in compiled.comparisons:
+		df = meta.get_field(fieldname)
+		numeric = fieldname in ("docstatus", "idx") or (df and df.fieldtype in NUMERIC_FIELDTYPES)
+		if operator != "==" and (quoted or not numeric):
 			return False
+	return True
+
 
-		last_update_log = frappe.get_doc("Stream Update Log", last_update_log[0].name)
-		return len([x for x in last_update_log.consumers if x.consumer == consumer.name])
+def get_columns(ref_doctype):
+	meta = frappe.get_meta(ref_doctype)
+	return set(default_fields) | {df.fieldname for df in meta.fields if df.fieldtype not in no_value_fields}
 
-	doc = frappe.get_doc(update_log.ref_doctype, update_log.docname)
+
+def get_condition_docs(ref_doctype, docnames, compiled):
+	"""Load the documents a condition is evaluated on, only the fields it reads when they are all columns"""
+	if not docnames:
+		return {}
+
+	if not compiled.cmd and compiled.fieldnames <= get_columns(ref_doctype):
+		docs = frappe.get_all(
+			ref_doctype,
+			filters={"name": ("in", list(docnames))},
+			fields=list(compiled.fieldnames | {"name"}),
+		)
+		return {doc.name: doc for doc in docs}
+
+	# the condition needs the whole document, e.g. child tables or controller methods
+	return {docname: frappe.get_doc(ref_doctype, docname) for docname in docnames}
+
+
+def evaluate_condition(consumer, compiled, doc, update_log):
 	try:
-		for dt_entry in consumer.consumer_doctypes:
-			if dt_entry.ref_doctype != update_log.ref_doctype:
-				continue
-
-			if not dt_entry.condition:
-				return True
-
-			condition: str = dt_entry.condition
-			if condition.startswith("cmd:"):
-				cmd = condition.split("cmd:")[1].strip()
-				args = {"consumer": consumer, "doc": doc, "update_log": update_log}
-				return frappe.call(cmd, **args)
-			else:
-				return frappe.safe_eval(condition, frappe._dict(doc=doc))
+		if compiled.cmd:
+			if not compiled.method:
+				compiled.method = frappe.get_attr(compiled.cmd)
+			args = {"consumer": consumer, "doc": doc, "update_log": update_log}
+			return frappe.call(compiled.method, **args)
+		else:
+			return frappe.safe_eval(compiled.condition, frappe._dict(doc=doc))
 	except Exception as e:
 		consumer.log_error("has_consumer_access error")
 	return False
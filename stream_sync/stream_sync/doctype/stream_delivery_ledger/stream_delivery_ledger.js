@@ -0,0 +1,8 @@
+// Copyright (c) 2026, Jufer and contributors
+// For license information, please see license.txt
+
+// frappe.ui.form.on("Stream Delivery Ledger", {
+// 	refresh(frm) {
+
+// 	},
+// });
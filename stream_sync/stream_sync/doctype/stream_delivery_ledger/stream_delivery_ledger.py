@@ -0,0 +1,98 @@
+# Copyright (c) 2026, Jufer and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import now
+
+
+class StreamDeliveryLedger(Document):
+	pass
+
+
+def get_delivery_watermarks(consumer_name, keys):
+	"""
+	Get the last Stream Update Log delivered to the consumer for each document
+	:param keys: iterable of (ref_doctype, docname)
+	:return: dict of (ref_doctype, docname) -> ledger row, one query per doctype
+	"""
+	names_by_doctype = {}
+	for ref_doctype, docname in keys:
+		names_by_doctype.setdefault(ref_doctype, set()).add(docname)
+
+	watermarks = {}
+	for ref_doctype, docnames in names_by_doctype.items():
+		rows = frappe.get_all(
+			"Stream Delivery Ledger",
+			filters={
+				"consumer": consumer_name,
+				"ref_doctype": ref_doctype,
+				"docname": ("in", list(docnames)),
+			},
+			fields=["name", "ref_doctype", "docname", "last_update_log", "last_update_creation"],
+		)
+		for row in rows:
+			watermarks[(row.ref_doctype, row.docname)] = row
+
+	return watermarks
+
+
+def mark_delivered(consumer_name, update_logs):
+	"""
+	Move the consumer's watermark of every document to the newest of the given logs
+	Existing ledger rows are replaced with one delete and one bulk insert
+	"""
+	latest = {}
+	for log in update_logs:
+		key = (log.ref_doctype, log.docname)
+		if key not in latest or (log.creation, log.name) > (latest[key].creation, latest[key].name):
+			latest[key] = log
+
+	if not latest:
+		return
+
+	watermarks = get_delivery_watermarks(consumer_name, latest.keys())
+	for key, row in watermarks.items():
+		# never move a watermark backwards
+		if (row.last_update_creation, row.last_update_log) >= (latest[key].creation, latest[key].name):
+			del latest[key]
+
+	stale = [watermarks[key].name for key in latest if key in watermarks]
+	if stale:
+		frappe.db.delete("Stream Delivery Ledger", {"name": ("in", stale)})
+
+	timestamp = now()
+	frappe.db.bulk_insert(
+		"Stream Delivery Ledger",
+		fields=[
+			"name",
+			"creation",
+			"modified",
+			"owner",
+			"modified_by",
+			"consumer",
+			"ref_doctype",
+			"docname",
+			"last_update_log",
+			"last_update_creation",
+		],
+		values=[
+			(
+				frappe.generate_hash(length=10),
+				timestamp,
+				timestamp,
+				frappe.session.user,
+				frappe.session.user,
+				consumer_name,
+				log.ref_doctype,
+				log.docname,
+				log.name,
+				log.creation,
+			)
+			for log in latest.values()
+		],
+	)
+
+
+def on_doctype_update():
+	frappe.db.add_unique("Stream Delivery Ledger", ["consumer", "ref_doctype", "docname"])
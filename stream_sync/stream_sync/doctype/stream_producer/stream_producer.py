@@ -1,18 +1,88 @@
 # Copyright (c) 2025, Jufer and contributors
 # For license information, please see license.txt
+import copy
 import json
 import time
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 
 import requests
 
 import frappe
 from frappe import _
+from frappe.model import table_fields
 from frappe.model.document import Document
-from frappe.utils.data import get_link_to_form, get_url
+from frappe.utils.data import (
+	add_to_date,
+	cint,
+	get_datetime,
+	get_link_to_form,
+	get_url,
+	now_datetime,
+	time_diff_in_seconds,
+)
 from frappe.frappeclient import FrappeClient
 from frappe.custom.doctype.custom_field.custom_field import create_custom_field
 from frappe.utils.password import get_decrypted_password
-from frappe.utils.background_jobs import get_jobs
+
+from stream_sync.stream_sync.doctype.doctype_mapping.doctype_mapping import get_mapping_plan
+from stream_sync.stream_sync.doctype.stream_sync_log.stream_sync_log import decode_log_data, encode_log_data
+from stream_sync.utils import (
+	DOC_REQUESTS_PER_CALL,
+	REMOTE_CLIENTS_VERSION_KEY,
+	NameDigest,
+	bump_cache_version,
+	debounce,
+	get_bench_site,
+	get_link_doctypes,
+	get_remote_client,
+	get_remote_docs,
+	get_update_links,
+	refresh_debounce,
+	release_debounce,
+)
+
+# number of updates requested from the producer per page
+PAGE_LENGTH = 500
+
+# how long a queued pull blocks further pulls from the same producer
+PULL_DEBOUNCE_TTL = 300
+
+# seconds a pull job may run when the producer does not set pull_timeout
+DEFAULT_PULL_TIMEOUT = 1500
+
+# local master names above which no digest is built and the producer is not asked to bundle masters
+MAX_DIGEST_NAMES = 500000
+
+# a held digest is rebuilt after this many seconds, until then masters deleted locally stay in it
+HELD_DIGEST_TTL = 86400
+
+# room left in a held digest for masters added by later pulls, as a share of the names it is built with
+HELD_DIGEST_HEADROOM = 0.25
+
+# masters created this many seconds before a held digest was last updated are added again,
+# so those of transactions that were still open then are not missed
+HELD_DIGEST_MARGIN = 600
+
+# get_docs calls made at once while prefetching, see PullCache.prefetch_links
+PREFETCH_WORKERS = 8
+
+# how long a parallel pull may go without dispatching or finishing a partition before another one
+# can start, on top of the producer's pull timeout, see pull_in_parallel
+PARALLEL_PULL_TTL = 1800
+
+# every shared master is inserted inside this savepoint, see insert_shared_masters
+SHARED_MASTER_SAVEPOINT = "stream_sync_shared_master"
+
+# every update is applied inside this savepoint, see sync
+SYNC_SAVEPOINT = "stream_sync_update"
+BULK_INSERT_SAVEPOINT = "stream_sync_bulk_insert"
+
+# unique (remote_site_name, remote_docname) index of doctypes not named as on the producer
+REMOTE_NAME_INDEX = "remote_name"
+
 
 class StreamProducer(Document):
 	def before_insert(self):
@@ -53,6 +123,12 @@ class StreamProducer(Document):
 			self.db_set("incoming_change", 0)
 			self.reload()
 
+	def clear_cache(self):
+		# credentials may have changed, rebuild the cached clients
+		bump_cache_version(REMOTE_CLIENTS_VERSION_KEY)
+		frappe.db.after_commit.add(lambda: bump_cache_version(REMOTE_CLIENTS_VERSION_KEY))
+		return super().clear_cache()
+
 	def on_trash(self):
 		last_update = frappe.db.get_value("Stream Producer Last Update", dict(stream_producer=self.name))
 		if last_update:
@@ -88,7 +164,7 @@ class StreamProducer(Document):
 					)
 				)
 
-	def set_last_update(self, last_update):
+	def set_last_update(self, last_update, last_name=None):
 		last_update_doc_name = frappe.db.get_value(
 			"Stream Producer Last Update", dict(stream_producer=self.name)
 		)
@@ -98,11 +174,14 @@ class StreamProducer(Document):
 					doctype="Stream Producer Last Update",
 					stream_producer=self.producer_url,
 					last_update=last_update,
+					last_update_name=last_name,
 				)
 			).insert(ignore_permissions=True)
 		else:
 			frappe.db.set_value(
-				"Stream Producer Last Update", last_update_doc_name, "last_update", last_update
+				"Stream Producer Last Update",
+				last_update_doc_name,
+				{"last_update": last_update, "last_update_name": last_name},
 			)
 
 	def get_last_update(self):
@@ -110,6 +189,14 @@ class StreamProducer(Document):
 			"Stream Producer Last Update", dict(stream_producer=self.name), "last_update"
 		)
 
+	def get_last_cursor(self):
+		"""(creation, name) of the last consumed Stream Update Log"""
+		return frappe.db.get_value(
+			"Stream Producer Last Update",
+			dict(stream_producer=self.name),
+			["last_update", "last_update_name"],
+		) or (None, None)
+
 	def get_request_data(self):
 		consumer_doctypes = []
 		for entry in self.producer_doctypes:
@@ -151,6 +238,8 @@ class StreamProducer(Document):
 						fieldtype="Data",
 						read_only=1,
 						print_hide=1,
+						# amended or duplicated documents are not the producer's, see add_remote_name_index
+						no_copy=1,
 					)
 					create_custom_field(entry.ref_doctype, df)
 				if not frappe.db.exists(
@@ -162,8 +251,10 @@ class StreamProducer(Document):
 						fieldtype="Data",
 						read_only=1,
 						print_hide=1,
+						no_copy=1,
 					)
 					create_custom_field(entry.ref_doctype, df)
+				add_remote_name_index(entry.ref_doctype)
 
 	def update_stream_consumer(self):
 		if self.is_producer_online():
@@ -209,14 +300,8 @@ class StreamProducer(Document):
 
 
 def get_producer_site(producer_url):
-	"""create a FrappeClient object for Stream producer site"""
-	producer_doc = frappe.get_doc("Stream Producer", producer_url)
-	producer_site = FrappeClient(
-		url=producer_url,
-		api_key=producer_doc.api_key,
-		api_secret=producer_doc.get_password("api_secret"),
-	)
-	return producer_site
+	"""get the shared FrappeClient object for Stream producer site"""
+	return get_remote_client("Stream Producer", producer_url)
 
 
 def get_approval_status(config, ref_doctype):
@@ -229,36 +314,435 @@ def get_approval_status(config, ref_doctype):
 
 @frappe.whitelist()
 def pull_producer_data():
-	"""Fetch data from producer node."""
-	response = requests.get(get_url())
-	if response.status_code == 200:
-		for stream_producer in frappe.get_all("Stream Producer"):
-			pull_from_node(stream_producer.name)
-		return "success"
-	return None
+	"""Queue a pull from every producer, each in its own job so a slow or unreachable producer only delays itself"""
+	for producer_url in frappe.get_all("Stream Producer", pluck="name"):
+		enqueue_pull(producer_url)
+	return "success"
+
+
+def enqueue_pull(producer_url):
+	"""Queue pull_from_node unless a pull from this producer is already queued"""
+	if not debounce(get_pull_debounce_key(producer_url), PULL_DEBOUNCE_TTL):
+		return
+
+	timeout = frappe.db.get_value("Stream Producer", producer_url, "pull_timeout")
+	frappe.enqueue(
+		"stream_sync.stream_sync.doctype.stream_producer.stream_producer.pull_from_node",
+		queue="long",
+		timeout=get_pull_timeout(timeout),
+		stream_producer=producer_url,
+	)
+
+
+def get_pull_timeout(pull_timeout):
+	return cint(pull_timeout) or DEFAULT_PULL_TIMEOUT
 
 
 @frappe.whitelist()
 def pull_from_node(stream_producer):
 	"""pull all updates after the last update timestamp from Stream producer site"""
+	# notifications received from now on need a new pull
+	release_debounce(get_pull_debounce_key(stream_producer))
+
 	stream_producer = frappe.get_doc("Stream Producer", stream_producer)
-	producer_site = get_producer_site(stream_producer.producer_url)
-	last_update = stream_producer.get_last_update()
+	if cint(stream_producer.parallel_jobs) > 1:
+		pull_in_parallel(stream_producer)
+		return
 
-	(doctypes, mapping_config, naming_config) = get_config(stream_producer.producer_doctypes)
+	# a notification arriving while this pull runs is kept for when it finishes,
+	# a second job pulling from the same cursor would apply every update twice
+	ttl = get_pull_timeout(stream_producer.pull_timeout) + PULL_DEBOUNCE_TTL
+	if not debounce(get_pull_debounce_key(stream_producer.name, "running"), ttl):
+		debounce(get_pull_debounce_key(stream_producer.name, "pending"), ttl)
+		return
 
-	updates = get_updates(producer_site, last_update, doctypes)
+	try:
+		pull_sequentially(stream_producer)
+	finally:
+		release_debounce(get_pull_debounce_key(stream_producer.name, "running"))
+		if release_debounce(get_pull_debounce_key(stream_producer.name, "pending")):
+			enqueue_pull(stream_producer.name)
+
+
+def pull_sequentially(stream_producer):
+	"""Apply the pending pages in this job, in batches, see SyncBatch"""
+	producer_site = PullCache(get_producer_site(stream_producer.producer_url))
+	last_update, last_name = stream_producer.get_last_cursor()
+	context = PullContext(stream_producer)
+
+	held_digest = get_held_digest(stream_producer) if stream_producer.bundle_dependencies else None
+
+	batch = SyncBatch(stream_producer)
+	# only one page is held in memory at a time, it is applied before the next is fetched
+	for page in get_update_pages(
+		producer_site,
+		last_update,
+		context.doctypes,
+		last_name,
+		compact=stream_producer.compact_updates,
+		held_digest=held_digest,
+	):
+		producer_site.add_docs(page.dependencies)
+		updates = [prepare_update(update, producer_site, context) for update in page.updates]
+		set_local_names(updates, stream_producer.name)
+		producer_site.prefetch_links(updates, context.source_doctypes)
+		bulk_insert_creates(updates, producer_site, stream_producer, context)
+		for update in updates:
+			sync(update, producer_site, stream_producer, context=context, logs=batch.logs)
+			batch.add(update)
+
+		# the producer may have skipped logs after the page's last update
+		batch.advance(page.last_update, page.last_name)
+		producer_site.forget_remote(context.source_doctypes)
+
+	batch.commit()
+
+
+def prepare_update(update, producer_site, context):
+	"""Apply the naming and mapping configuration to a pulled update and decode its data"""
+	update.use_same_name = context.naming_config.get(update.ref_doctype)
+	mapping = context.mapping_config.get(update.ref_doctype)
+	if mapping:
+		update.mapping = mapping
+		update = get_mapped_update(update, producer_site)
+	if not update.update_type == "Delete":
+		update.data = frappe.parse_json(update.data)
+	return update
 
-	for update in updates:
-		update.use_same_name = naming_config.get(update.ref_doctype)
-		mapping = mapping_config.get(update.ref_doctype)
-		if mapping:
-			update.mapping = mapping
-			update = get_mapped_update(update, producer_site)
-		if not update.update_type == "Delete":
-			update.data = json.loads(update.data)
 
-		sync(update, producer_site, stream_producer)
+class SyncBatch:
+	"""
+	Applies updates in one transaction until apply_batch_size updates were synced
+	or commit_interval seconds passed, then checkpoints the cursor and commits
+	"""
+
+	def __init__(self, stream_producer, checkpoint=True):
+		self.stream_producer = stream_producer
+		self.checkpoint = checkpoint
+		self.size = cint(stream_producer.apply_batch_size) or 1
+		self.interval = cint(stream_producer.commit_interval)
+		# a compacted update sits at the position of the last log it merges, past logs of other
+		# documents the producer already counts as delivered, only a page end is a safe cursor
+		self.page_cursor_only = bool(stream_producer.compact_updates)
+		self.cursor = None
+		self.logs = SyncLogBuffer(stream_producer)
+		self.reset()
+
+	def reset(self):
+		self.pending = 0
+		self.started = time.monotonic()
+
+	def add(self, update):
+		if not self.page_cursor_only:
+			self.advance(update.creation, update.name)
+		self.pending += 1
+		if self.pending >= self.size or (self.interval and time.monotonic() - self.started >= self.interval):
+			self.commit()
+
+	def advance(self, last_update, last_name):
+		# injected history is older than the cursor it was served after, never move back
+		if last_update and (not self.cursor or (str(last_update), last_name) > self.cursor):
+			self.cursor = (str(last_update), last_name)
+
+	def commit(self):
+		self.logs.flush()
+		if self.checkpoint and self.cursor:
+			self.stream_producer.set_last_update(*self.cursor)
+		frappe.db.commit()
+		self.reset()
+
+
+class SyncLogBuffer:
+	"""
+	Stream Sync Logs of the updates of a batch, kept as the producer's Sync Log Policy says
+	and written with one multi-row INSERT when the batch commits
+	"""
+
+	def __init__(self, stream_producer):
+		self.stream_producer = stream_producer.name
+		self.policy = stream_producer.sync_log_policy or "All"
+		self.sample_rate = cint(stream_producer.sync_log_sample_rate) or 1
+		self.data_format = stream_producer.sync_log_data or "Full"
+		self.synced = 0
+		self.logs = []
+
+	def add(self, update, sync_status, error=None):
+		if sync_status == "Synced":
+			self.synced += 1
+			if self.policy == "Failures Only" or (
+				self.policy == "Sampled" and self.synced % self.sample_rate
+			):
+				return
+
+		doc = get_sync_log(update, self.stream_producer, sync_status, error, self.data_format)
+		doc.name = frappe.generate_hash(length=10)
+		doc.owner = doc.modified_by = frappe.session.user
+		doc.creation = doc.modified = frappe.utils.now()
+		self.logs.append(doc)
+
+	def flush(self):
+		insert_rows(self.logs)
+		self.logs = []
+
+
+def pull_in_parallel(stream_producer):
+	"""
+	Apply the pending pages with parallel_jobs RQ jobs per page, see dispatch_page
+	A notification arriving while a parallel pull runs is kept for when it finishes
+	"""
+	ttl = get_parallel_pull_ttl(stream_producer)
+	if not debounce(get_parallel_pull_key(stream_producer.name), ttl):
+		debounce(get_parallel_pull_key(stream_producer.name, "pending"), ttl)
+		return
+
+	dispatch_page(stream_producer, *stream_producer.get_last_cursor())
+
+
+def dispatch_page(stream_producer, last_update, last_name):
+	"""
+	Fetch the page after the cursor and enqueue one apply_partition job per partition
+	The last partition to finish checkpoints the page and dispatches the next one,
+	so the checkpoint never passes an update some partition has not applied yet
+	When fetching or dispatching fails the pull is finished, the next one starts from the checkpoint
+	"""
+	ttl = get_parallel_pull_ttl(stream_producer)
+	try:
+		producer_site = get_producer_site(stream_producer.producer_url)
+		context = PullContext(stream_producer)
+		held_digest = get_held_digest(stream_producer) if stream_producer.bundle_dependencies else None
+
+		while True:
+			# the pull is alive as long as it dispatches pages
+			refresh_debounce(get_parallel_pull_key(stream_producer.name), ttl)
+			refresh_debounce(get_parallel_pull_key(stream_producer.name, "pending"), ttl)
+			page = get_update_page(
+				producer_site,
+				last_update,
+				context.doctypes,
+				last_name,
+				compact=stream_producer.compact_updates,
+				held_digest=held_digest,
+			)
+			partitions = partition_updates(page.updates, cint(stream_producer.parallel_jobs))
+			if partitions:
+				insert_shared_masters(stream_producer, PullCache(producer_site), partitions, page, context)
+				frappe.db.commit()
+				frappe.cache().set(
+					frappe.cache().make_key(get_parallel_pull_key(stream_producer.name, "partitions")),
+					len(partitions),
+					ex=ttl,
+				)
+				for updates in partitions:
+					frappe.enqueue(
+						"stream_sync.stream_sync.doctype.stream_producer.stream_producer.apply_partition",
+						queue="long",
+						timeout=get_pull_timeout(stream_producer.pull_timeout),
+						stream_producer=stream_producer.name,
+						updates=updates,
+						dependencies=page.dependencies,
+						page_cursor=(page.last_update, page.last_name),
+						has_more=page.has_more,
+					)
+				return
+
+			# nothing this consumer can apply in the page
+			if page.last_update:
+				stream_producer.set_last_update(page.last_update, page.last_name)
+				frappe.db.commit()
+			if not page.has_more:
+				finish_parallel_pull(stream_producer.name)
+				return
+			last_update, last_name = page.last_update, page.last_name
+	except Exception:
+		# release the pull, otherwise every pull from this producer waits for the running key to expire
+		frappe.db.rollback()
+		finish_parallel_pull(stream_producer.name)
+		raise
+
+
+def insert_shared_masters(stream_producer, producer_site, partitions, page, context):
+	"""
+	Insert the missing masters linked from more than one partition before the partitions are enqueued,
+	otherwise their jobs insert the same master at once and all but one fail with a duplicate entry
+	A master that can not be inserted here is left to the partitions, where the error is logged
+	"""
+	producer_site.add_docs(page.dependencies)
+	partition_by_link = {}
+	shared = set()
+	for index, updates in enumerate(partitions):
+		for update in updates:
+			if update.update_type == "Delete" or update.ref_doctype in context.mapping_config:
+				continue
+			for key in get_update_links(
+				update.ref_doctype, update.update_type, frappe.parse_json(update.data)
+			):
+				if partition_by_link.setdefault(key, index) != index:
+					shared.add(key)
+
+	for doctype, name in shared:
+		if not producer_site.is_installed(doctype) or producer_site.exists(doctype, name):
+			continue
+		frappe.db.savepoint(SHARED_MASTER_SAVEPOINT)
+		try:
+			master = frappe.get_doc(producer_site.get_doc(doctype, name))
+			sync_dependencies(master, producer_site, stream_producer.name)
+			master.insert(set_name=name, ignore_permissions=True)
+		except Exception:
+			frappe.db.rollback(save_point=SHARED_MASTER_SAVEPOINT)
+			producer_site.forget_local()
+		else:
+			frappe.db.release_savepoint(SHARED_MASTER_SAVEPOINT)
+			producer_site.set_local(doctype, name)
+
+
+def apply_partition(stream_producer, updates, page_cursor, has_more, dependencies=None):
+	"""Apply one partition of a page in order, then continue the pull if it was the last one running"""
+	stream_producer = frappe.get_doc("Stream Producer", stream_producer)
+	applied = False
+	try:
+		producer_site = PullCache(get_producer_site(stream_producer.producer_url))
+		producer_site.add_docs(dependencies)
+		context = PullContext(stream_producer)
+
+		updates = [prepare_update(frappe._dict(update), producer_site, context) for update in updates]
+		set_local_names(updates, stream_producer.name)
+		producer_site.prefetch_links(updates, context.source_doctypes)
+		bulk_insert_creates(updates, producer_site, stream_producer, context)
+
+		batch = SyncBatch(stream_producer, checkpoint=False)
+		for update in updates:
+			sync(update, producer_site, stream_producer, context=context, logs=batch.logs)
+			batch.add(update)
+		batch.commit()
+		applied = True
+	finally:
+		if not applied:
+			frappe.db.rollback()
+		finish_partition(stream_producer, page_cursor, has_more, applied)
+
+
+def finish_partition(stream_producer, page_cursor, has_more, applied):
+	"""
+	Count a partition of the page as done, the last one checkpoints the page and dispatches the next
+	When a partition did not finish, the page is not checkpointed and the pull stops,
+	the next pull applies the page again from the previous checkpoint
+	"""
+	ttl = get_parallel_pull_ttl(stream_producer)
+	failed_key = get_parallel_pull_key(stream_producer.name, "failed")
+	if not applied:
+		debounce(failed_key, ttl)
+
+	key = frappe.cache().make_key(get_parallel_pull_key(stream_producer.name, "partitions"))
+	if frappe.cache().decr(key) > 0:
+		refresh_debounce(get_parallel_pull_key(stream_producer.name), ttl)
+		return
+
+	frappe.cache().delete(key)
+	if release_debounce(failed_key):
+		finish_parallel_pull(stream_producer.name)
+		return
+
+	stream_producer.set_last_update(*page_cursor)
+	frappe.db.commit()
+	if has_more:
+		dispatch_page(stream_producer, *page_cursor)
+	else:
+		finish_parallel_pull(stream_producer.name)
+
+
+def finish_parallel_pull(producer_url):
+	release_debounce(get_parallel_pull_key(producer_url))
+	if release_debounce(get_parallel_pull_key(producer_url, "pending")):
+		new_stream_notification(producer_url)
+
+
+def get_parallel_pull_ttl(stream_producer):
+	return PARALLEL_PULL_TTL + get_pull_timeout(stream_producer.pull_timeout)
+
+
+def get_parallel_pull_key(producer_url, suffix="running"):
+	return f"stream_sync_parallel_pull:{producer_url}:{suffix}"
+
+
+def partition_updates(updates, partitions):
+	"""
+	Split the updates of a page into at most `partitions` lists by hash of (ref_doctype, docname)
+	Each list keeps page order, so the updates of a document stay in order in one partition
+	Updates referring to the name of another document in the page are kept in the same partition
+	so a document is applied after the documents it links to
+	"""
+	keys = [(u.ref_doctype, u.docname) for u in updates]
+	parent = {key: key for key in keys}
+
+	def find(key):
+		while parent[key] != key:
+			parent[key] = parent[parent[key]]
+			key = parent[key]
+		return key
+
+	by_name = {}
+	for key in keys:
+		by_name.setdefault(key[1], set()).add(key)
+
+	for key, update in zip(keys, updates, strict=True):
+		if update.update_type == "Delete":
+			continue
+		for value in iter_strings(json.loads(update.data)):
+			for linked in by_name.get(value, ()):
+				parent[find(linked)] = find(key)
+
+	grouped = {}
+	for key, update in zip(keys, updates, strict=True):
+		root = find(key)
+		index = zlib.crc32("\0".join(root).encode()) % partitions
+		grouped.setdefault(index, []).append(update)
+
+	return list(grouped.values())
+
+
+def iter_strings(value):
+	"""All string values nested in decoded update data, candidates for links to other documents"""
+	if isinstance(value, str):
+		yield value
+	elif isinstance(value, dict):
+		for v in value.values():
+			yield from iter_strings(v)
+	elif isinstance(value, list):
+		for v in value:
+			yield from iter_strings(v)
+
+
+class PullContext:
+	"""
+	Configuration of one pull from a producer, read when the pull starts and not changed after,
+	so applying an update runs no configuration queries
+	"""
+
+	def __init__(self, stream_producer):
+		(doctypes, mapping_config, naming_config) = get_config(stream_producer.producer_doctypes)
+		self.doctypes = tuple(doctypes)
+		# keyed by the producer's doctype
+		self.mapping_config = MappingProxyType(mapping_config)
+		self.naming_config = MappingProxyType(naming_config)
+		# Stream Producer Doctype rows keyed by the local doctype
+		self.doctype_config = MappingProxyType(
+			{entry.ref_doctype: frappe._dict(entry.as_dict()) for entry in stream_producer.producer_doctypes}
+		)
+		self.source_doctypes = frozenset(get_source_doctypes(stream_producer))
+		self.mappings = MappingProxyType(load_mappings(mapping_config.values()))
+
+
+def load_mappings(names):
+	"""Doctype Mappings by name, with the mappings they refer to for child tables and documents"""
+	mappings = {}
+	pending = list(names)
+	while pending:
+		name = pending.pop()
+		if not name or name in mappings:
+			continue
+		mappings[name] = frappe.get_doc("Doctype Mapping", name)
+		pending.extend(m.mapping for m in mappings[name].field_mapping if m.get("mapping"))
+	return mappings
 
 
 def get_config(stream_config):
@@ -280,35 +764,63 @@ def get_config(stream_config):
 	return (doctypes, mapping_config, naming_config)
 
 
-def sync(update, producer_site, stream_producer, in_retry=False):
-	"""Sync the individual update"""
+def get_source_doctypes(stream_producer):
+	"""Doctypes whose updates are applied from the whole remote document, see set_update"""
+	return {
+		entry.ref_doctype
+		for entry in stream_producer.producer_doctypes
+		if entry.status == "Actived" and not entry.has_mapping and entry.amend_mode == "Update Source"
+	}
+
+
+def sync(update, producer_site, stream_producer, in_retry=False, context=None, logs=None):
+	"""
+	Sync the individual update, a failure only rolls back this update's changes
+	:param logs: SyncLogBuffer of the batch, the log is inserted right away without one
+	"""
+	context = context or PullContext(stream_producer)
+	if update.bulk_inserted:
+		log_stream_sync(update, stream_producer.name, "Synced", logs=logs)
+		return
+
+	frappe.db.savepoint(SYNC_SAVEPOINT)
 	try:
 		if update.update_type == "Create":
-			set_insert(update, producer_site, stream_producer.name)
+			set_insert(update, producer_site, stream_producer.name, context)
 		if update.update_type == "Update":
-			set_update(update, producer_site, stream_producer.name)
+			set_update(update, producer_site, stream_producer.name, context)
 		if update.update_type == "Delete":
-			set_delete(update)
-		if in_retry:
-			return "Synced"
-		log_stream_sync(update, stream_producer.name, "Synced")
+			set_delete(update, producer_site, stream_producer.name)
 
 	except Exception:
+		frappe.db.rollback(save_point=SYNC_SAVEPOINT)
+		# masters inserted for this update are gone again
+		producer_site.forget_local()
 		if in_retry:
 			if frappe.flags.in_test:
 				print(frappe.get_traceback())
 			return "Failed"
-		log_stream_sync(update, stream_producer.name, "Failed", frappe.get_traceback())
+		log_stream_sync(update, stream_producer.name, "Failed", frappe.get_traceback(), logs=logs)
 
-	stream_producer.set_last_update(update.creation)
-	frappe.db.commit()
+	else:
+		frappe.db.release_savepoint(SYNC_SAVEPOINT)
+		if in_retry:
+			return "Synced"
+		log_stream_sync(update, stream_producer.name, "Synced", logs=logs)
 
 
-def set_insert(update, producer_site, stream_producer):
+def set_insert(update, producer_site, stream_producer, context):
 	"""Sync insert type update"""
-	if frappe.db.get_value(update.ref_doctype, update.docname):
-		# doc already created
-		return
+	if update.use_same_name:
+		if frappe.db.exists(update.ref_doctype, update.docname):
+			# doc already created
+			return
+	else:
+		local_docname = get_local_name(update, stream_producer)
+		if local_docname:
+			# doc already created, e.g. when a page is applied again
+			update.local_docname = local_docname
+			return
 	doc = frappe.get_doc(update.data)
 	
 	if update.mapping:
@@ -319,7 +831,7 @@ def set_insert(update, producer_site, stream_producer):
 	else:
 		sync_dependencies(doc, producer_site, stream_producer)
 
-	producers_doctype = frappe.db.get_value("Stream Producer Doctype", {"parent": stream_producer, "ref_doctype": update.ref_doctype}, "*", as_dict=True)
+	producers_doctype = context.doctype_config[update.ref_doctype]
 
 	doc.flags.ignore_permissions = True
 	doc.flags.from_producer = True
@@ -336,35 +848,152 @@ def set_insert(update, producer_site, stream_producer):
 		doc.remote_docname = update.docname
 		doc.remote_site_name = stream_producer
 		doc.insert(set_child_names=False)
+		update.local_docname = doc.name
+	producer_site.set_local(doc.doctype, doc.name)
 
 
-def set_update(update, producer_site, stream_producer):
+def bulk_insert_creates(updates, producer_site, stream_producer, context):
+	"""
+	Insert the Creates of doctypes set to Bulk Insert with one multi-row INSERT per table,
+	without running the controller, and mark them bulk_inserted for sync to only log them
+	Only documents with no other update in the page qualify; if the insert fails
+	the documents are left to the one by one path
+	"""
+	counts = Counter((update.ref_doctype, update.docname) for update in updates)
+	by_doctype = {}
+	for update in updates:
+		config = context.doctype_config.get(update.ref_doctype)
+		if (
+			update.update_type == "Create"
+			and config
+			and config.bulk_insert
+			and config.ignore_validate
+			and config.ignore_mandatory
+			and counts[(update.ref_doctype, update.docname)] == 1
+		):
+			by_doctype.setdefault(update.ref_doctype, []).append(update)
+
+	for doctype, creates in by_doctype.items():
+		frappe.db.savepoint(BULK_INSERT_SAVEPOINT)
+		try:
+			docs = get_bulk_insert_docs(doctype, creates, producer_site, stream_producer, context)
+			insert_docs([doc for _update, doc in docs])
+		except Exception:
+			frappe.db.rollback(save_point=BULK_INSERT_SAVEPOINT)
+			producer_site.forget_local()
+			continue
+
+		frappe.db.release_savepoint(BULK_INSERT_SAVEPOINT)
+		for update in creates:
+			update.bulk_inserted = True
+		for update, doc in docs:
+			update.local_docname = doc.name
+			producer_site.set_local(doc.doctype, doc.name)
+
+
+def get_bulk_insert_docs(doctype, creates, producer_site, stream_producer, context):
+	"""(update, Document) for the Creates whose document does not exist yet, named and ready to insert"""
+	config = context.doctype_config[doctype]
+	docnames = [update.docname for update in creates]
+	if creates[0].use_same_name:
+		existing = set(frappe.get_all(doctype, filters={"name": ("in", docnames)}, pluck="name"))
+	else:
+		existing = set(
+			frappe.get_all(
+				doctype,
+				filters={"remote_docname": ("in", docnames), "remote_site_name": stream_producer},
+				pluck="remote_docname",
+			)
+		)
+
+	now = frappe.utils.now()
+	docs = []
+	for update in creates:
+		if update.docname in existing:
+			continue
+
+		doc = frappe.get_doc(update.data)
+		if update.mapping:
+			for fieldname, value in sync_mapped_dependencies(
+				update.dependencies or [], producer_site
+			).items():
+				doc.update({fieldname: value})
+		else:
+			sync_dependencies(doc, producer_site, stream_producer)
+
+		if config.target_docstatus != "Follow Source":
+			doc.docstatus = get_docstatus_target(config.target_docstatus)
+		if update.use_same_name:
+			doc.set_new_name(set_name=update.docname, set_child_names=False)
+		else:
+			doc.remote_docname = update.docname
+			doc.remote_site_name = stream_producer
+			doc.set_new_name(set_child_names=False)
+
+		doc.owner = doc.modified_by = frappe.session.user
+		doc.creation = doc.modified = now
+		doc.set_parent_in_children()
+		for child in doc.get_all_children():
+			child.name = child.name or frappe.generate_hash(length=10)
+			child.owner = child.modified_by = frappe.session.user
+			child.creation = child.modified = now
+			child.docstatus = doc.docstatus
+		docs.append((update, doc))
+	return docs
+
+
+def insert_docs(docs):
+	"""Write the documents and their child rows with one multi-row INSERT per table"""
+	rows = list(docs)
+	for doc in docs:
+		rows.extend(doc.get_all_children())
+	insert_rows(rows)
+
+
+def insert_rows(rows):
+	"""Write named documents or child rows, one multi-row INSERT per doctype"""
+	tables = {}
+	for row in rows:
+		tables.setdefault(row.doctype, []).append(row.get_valid_dict(convert_dates_to_str=True))
+
+	for table, values in tables.items():
+		fields = list(values[0])
+		frappe.db.bulk_insert(table, fields, [[value.get(field) for field in fields] for value in values])
+
+
+def set_update(update, producer_site, stream_producer, context):
 	"""Sync update type update"""
-	producers_doctype = frappe.db.get_value("Stream Producer Doctype", {"parent": stream_producer, "ref_doctype": update.ref_doctype}, "*", as_dict=True)
+	producers_doctype = context.doctype_config[update.ref_doctype]
+	if can_update_columns(update, producers_doctype):
+		set_update_columns(update, producer_site, stream_producer, producers_doctype)
+		return
 	if producers_doctype.amend_mode == "Update Source":
 		docu = producer_site.get_doc(update.ref_doctype, update.docname)
 		update.docname = check_amended_from(docu, producer_site)
+		# resolved for the amended document, the local one is the original's
+		update.local_docname = None
 		update.data.update({
 			"name": update.docname,
 			"amended_from": None
 		})
-	local_doc = get_local_doc(update)
+	local_doc = get_local_doc(update, stream_producer)
 	target_docstatus = get_docstatus_target(producers_doctype.target_docstatus)
 	if local_doc and (local_doc.docstatus == target_docstatus or target_docstatus == 3):
 		data = frappe._dict(update.data)
+		rows = ChildRowChanges.from_doc(local_doc)
 
-		if data.changed and producers_doctype.amend_mode != "Update Source":
-			local_doc.update(data.changed)
-		if data.removed and producers_doctype.amend_mode != "Update Source":
-			local_doc = update_row_removed(local_doc, data.removed)
-		if data.row_changed and producers_doctype.amend_mode != "Update Source":
-			update_row_changed(local_doc, data.row_changed)
-		if data.added and producers_doctype.amend_mode != "Update Source":
-			local_doc = update_row_added(local_doc, data.added)
 		if producers_doctype.amend_mode == "Update Source":
-			local_doc = update_non_table_fields(local_doc, data)
-			local_doc = replace_all_child_rows(local_doc, data)
-			local_doc = mapping_data(local_doc, update.mapping)
+			# the whole remote document, under the name and lineage of the local one
+			source = dict(docu, name=update.docname, amended_from=None)
+			local_doc = update_non_table_fields(local_doc, source)
+			rows.add_source(source)
+		else:
+			if data.changed:
+				local_doc.update(data.changed)
+			rows.add_diff(data)
+		rows.apply_to(local_doc)
+		if producers_doctype.amend_mode == "Update Source":
+			local_doc = mapping_data(local_doc, update.mapping, context.mappings)
 		if update.mapping:
 			if update.get("dependencies"):
 				dependencies_created = sync_mapped_dependencies(update.dependencies, producer_site)
@@ -377,81 +1006,421 @@ def set_update(update, producer_site, stream_producer):
 		local_doc.flags.ignore_validate = producers_doctype.ignore_validate
 		local_doc.flags.ignore_version = True
 		local_doc.flags.ignore_permission = True
+		# save() updates the other rows along with the parent and deletes the removed ones,
+		# the new rows have the producer's names and have to exist beforehand
+		rows.insert()
 		local_doc.save()
 		local_doc.db_update_all()
+		update.local_docname = local_doc.name
 
 
-def update_row_removed(local_doc, removed):
-	"""Sync child table row deletion type update"""
-	for tablename, rownames in removed.items():
-		table = local_doc.get_table_field_doctype(tablename)
-		for row in rownames:
-			table_rows = local_doc.get(tablename)
-			child_table_row = get_child_table_row(table_rows, row)
-			table_rows.remove(child_table_row)
-			local_doc.set(tablename, table_rows)
-	return local_doc
+def can_update_columns(update, config):
+	"""
+	Whether the Update can be applied to the changed columns only: the doctype is set to Column Level Updates
+	and skips validation, and the diff neither needs mapping, amending, nor changes the docstatus
+	"""
+	return bool(
+		config.column_update
+		and config.ignore_validate
+		and config.amend_mode != "Update Source"
+		and not update.mapping
+		and "docstatus" not in (update.data.get("changed") or {})
+	)
+
+
+def set_update_columns(update, producer_site, stream_producer, config):
+	"""Sync update type update by writing the changed parent columns and child rows, without loading the document"""
+	name = update.docname if update.use_same_name else get_local_name(update, stream_producer)
+	local = name and frappe.db.get_value(update.ref_doctype, name, ["name", "docstatus"], as_dict=True)
+	target_docstatus = get_docstatus_target(config.target_docstatus)
+	if not local or (local.docstatus != target_docstatus and target_docstatus != 3):
+		return
 
+	data = frappe._dict(update.data)
+	# the changed values and rows as a transient document, for their links to be synced first
+	values = dict(data.changed or {})
+	for operation in ("row_changed", "added"):
+		for tablename, rows in (data.get(operation) or {}).items():
+			values[tablename] = values.get(tablename, []) + [dict(row) for row in rows]
+	values.update(doctype=update.ref_doctype, name=local.name)
+	sync_dependencies(frappe.get_doc(values), producer_site, stream_producer)
 
-def get_child_table_row(table_rows, row):
-	for entry in table_rows:
-		if entry.get("name") == row:
-			return entry
+	write_update_columns(update.ref_doctype, local, data)
+	update.local_docname = local.name
 
 
-def update_row_changed(local_doc, changed):
-	"""Sync child table row updation type update"""
-	for tablename, rows in changed.items():
-		old = local_doc.get(tablename)
-		for doc in old:
+def write_update_columns(doctype, local, data):
+	"""
+	Apply an Update diff with targeted statements: one UPDATE of the changed parent columns and modified,
+	then the child rows it changes, see ChildRowChanges
+	"""
+	meta = frappe.get_meta(doctype)
+	now, user = frappe.utils.now(), frappe.session.user
+
+	changed = get_column_values(meta, data.changed or {})
+	changed.update(modified=now, modified_by=user)
+	frappe.db.set_value(doctype, local.name, changed, update_modified=False)
+
+	rows = ChildRowChanges.from_db(doctype, local.name, local.docstatus, data)
+	rows.add_diff(data)
+	rows.write()
+
+	frappe.clear_document_cache(doctype, local.name)
+
+
+def get_column_values(meta, values):
+	"""The values of a diff that are columns of the doctype, without the ones that identify the row"""
+	columns = set(meta.get_valid_columns()) - {
+		"name",
+		"parent",
+		"parenttype",
+		"parentfield",
+		"owner",
+		"creation",
+		"modified",
+		"modified_by",
+	}
+	return {fieldname: value for fieldname, value in values.items() if fieldname in columns}
+
+
+class ChildRowChanges:
+	"""
+	The inserts, updates and deletes that bring the child tables of a local document to the state of the producer,
+	computed against its rows indexed by name and written with bulk statements per child doctype
+	"""
+
+	def __init__(self, doctype, parent, docstatus, existing):
+		self.meta = frappe.get_meta(doctype)
+		self.parent = parent
+		self.docstatus = docstatus
+		# table fieldname -> {row name: local row}, rows are only read by add_source
+		self.existing = existing
+		self.inserts = {}
+		self.updates = {}
+		self.deletes = {}
+		self.new_rows = None
+
+	@classmethod
+	def from_doc(cls, local_doc):
+		existing = {
+			df.fieldname: {row.name: row for row in local_doc.get(df.fieldname)}
+			for df in local_doc.meta.get_table_fields()
+		}
+		return cls(local_doc.doctype, local_doc.name, local_doc.docstatus, existing)
+
+	@classmethod
+	def from_db(cls, doctype, parent, docstatus, data):
+		"""Index only the names of the local rows of the tables the diff touches, one query per child doctype"""
+		meta = frappe.get_meta(doctype)
+		tablenames = set()
+		for operation in ("added", "removed", "row_changed"):
+			tablenames.update(data.get(operation) or {})
+
+		by_doctype = {}
+		for tablename in tablenames:
+			df = meta.get_field(tablename)
+			if df and df.fieldtype in table_fields:
+				by_doctype.setdefault(df.options, []).append(tablename)
+
+		existing = {}
+		for child_doctype, fieldnames in by_doctype.items():
+			for row in frappe.get_all(
+				child_doctype,
+				filters={"parent": parent, "parenttype": doctype, "parentfield": ("in", fieldnames)},
+				fields=["name", "parentfield"],
+				order_by=None,
+			):
+				existing.setdefault(row.parentfield, {})[row.name] = None
+		return cls(doctype, parent, docstatus, existing)
+
+	def add_diff(self, data):
+		"""Changes of an Update diff, rows it changes or removes that are not here are left alone"""
+		for tablename, rownames in (data.removed or {}).items():
+			for name in rownames:
+				if name in self.existing.get(tablename, ()):
+					self.deletes.setdefault(tablename, set()).add(name)
+
+		for operation in ("row_changed", "added"):
+			for tablename, rows in (data.get(operation) or {}).items():
+				if not self.get_child_meta(tablename):
+					continue
+				for row in rows:
+					if row.get("name") in self.existing.get(tablename, ()):
+						self.updates.setdefault(tablename, {}).setdefault(row["name"], {}).update(row)
+					elif operation == "added":
+						self.inserts.setdefault(tablename, []).append(row)
+
+	def add_source(self, source):
+		"""Changes that make the tables of the local document the tables of the whole remote document"""
+		for df in self.meta.get_table_fields():
+			rows = source.get(df.fieldname)
+			if not isinstance(rows, (list, tuple)):
+				continue
+			local_rows = self.existing.get(df.fieldname, {})
+			names = set()
 			for row in rows:
-				if row["name"] == doc.get("name"):
-					doc.update(row)
-
-
-def update_row_added(local_doc, added):
-	"""Sync child table row addition type update"""
-	for tablename, rows in added.items():
-		local_doc.extend(tablename, rows)
-		for child in rows:
-			child_doc = frappe.get_doc(child)
-			child_doc.parent = local_doc.name
-			child_doc.parenttype = local_doc.doctype
-			child_doc.insert(set_name=child_doc.name)
-	return local_doc
+				local_row = local_rows.get(row.get("name"))
+				if local_row is None:
+					self.inserts.setdefault(df.fieldname, []).append(row)
+					continue
+				names.add(row["name"])
+				values = {
+					fieldname: value
+					for fieldname, value in get_column_values(self.get_child_meta(df.fieldname), row).items()
+					if local_row.get(fieldname) != value
+				}
+				if values:
+					self.updates.setdefault(df.fieldname, {})[row["name"]] = values
+			removed = set(local_rows) - names
+			if removed:
+				self.deletes[df.fieldname] = removed
+
+	def get_child_meta(self, tablename):
+		df = self.meta.get_field(tablename)
+		if df and df.fieldtype in table_fields:
+			return frappe.get_meta(df.options)
+
+	def apply_to(self, local_doc):
+		"""Bring the child tables of the loaded document to the new state, in memory"""
+		for tablename in set(self.inserts) | set(self.updates) | set(self.deletes):
+			deletes, updates = self.deletes.get(tablename, ()), self.updates.get(tablename, {})
+			rows = [row for row in local_doc.get(tablename) if row.name not in deletes]
+			for row in rows:
+				if row.name in updates:
+					row.update(get_column_values(row.meta, updates[row.name]))
+			local_doc.set(tablename, rows)
+		for row in self.get_insert_rows():
+			local_doc.append(row.parentfield, row)
+
+	def write(self):
+		self.delete()
+		self.update()
+		self.insert()
+
+	def delete(self):
+		"""One DELETE per table with removed rows"""
+		for tablename, names in self.deletes.items():
+			frappe.db.delete(
+				self.get_child_meta(tablename).name,
+				{
+					"parent": self.parent,
+					"parenttype": self.meta.name,
+					"parentfield": tablename,
+					"name": ("in", list(names)),
+				},
+			)
+
+	def update(self):
+		"""The changed columns of all the changed rows of a child doctype with bulk UPDATEs"""
+		now, user = frappe.utils.now(), frappe.session.user
+		for tablename, updates in self.updates.items():
+			child_meta = self.get_child_meta(tablename)
+			values = {name: get_column_values(child_meta, row) for name, row in updates.items()}
+			values = {name: row for name, row in values.items() if row}
+			if values:
+				frappe.db.bulk_update(child_meta.name, values, modified=now, modified_by=user)
+
+	def insert(self):
+		"""All the new rows with one multi-row INSERT per child doctype"""
+		insert_rows(self.get_insert_rows())
+
+	def get_insert_rows(self):
+		if self.new_rows is None:
+			now, user = frappe.utils.now(), frappe.session.user
+			self.new_rows = []
+			for tablename, rows in self.inserts.items():
+				child_meta = self.get_child_meta(tablename)
+				for row in rows:
+					child = frappe.get_doc(dict(row, doctype=child_meta.name))
+					child.update(
+						parent=self.parent,
+						parenttype=self.meta.name,
+						parentfield=tablename,
+						docstatus=self.docstatus,
+					)
+					child.name = child.name or frappe.generate_hash(length=10)
+					child.owner = child.modified_by = user
+					child.creation = child.modified = now
+					self.new_rows.append(child)
+		return self.new_rows
 
 
-def set_delete(update):
+def set_delete(update, producer_site, stream_producer):
 	"""Sync delete type update"""
-	local_doc = get_local_doc(update)
+	local_doc = get_local_doc(update, stream_producer)
 	if local_doc:
 		local_doc.delete()
+		producer_site.set_local(local_doc.doctype, local_doc.name, exists=False)
 
 
-def get_updates(producer_site, last_update, doctypes):
-	"""Get all updates generated after the last update timestamp"""
-	docs = producer_site.post_request(
+def get_update_pages(producer_site, last_update, doctypes, last_name=None, compact=False, held_digest=None):
+	"""Yield the pages of updates generated after the last update cursor, fetching each one on demand"""
+	while True:
+		page = get_update_page(producer_site, last_update, doctypes, last_name, compact, held_digest)
+		yield page
+		if not page.has_more:
+			break
+		last_update, last_name = page.last_update, page.last_name
+
+
+def get_update_page(producer_site, last_update, doctypes, last_name=None, compact=False, held_digest=None):
+	"""
+	Get one page of updates generated after the (last_update, last_name) cursor
+	:param held_digest: NameDigest of the masters this site holds, asks the producer to bundle the others
+	"""
+	page = producer_site.post_request(
 		{
-			"cmd": "stream_sync.stream_sync.doctype.stream_update_log.stream_update_log.get_update_logs_for_consumer",
+			"cmd": "stream_sync.stream_sync.doctype.stream_update_log.stream_update_log.get_update_log_page",
 			"stream_consumer": get_url(),
 			"doctypes": frappe.as_json(doctypes),
 			"last_update": last_update,
+			"last_name": last_name,
+			"page_length": PAGE_LENGTH,
+			"compact": 1 if compact else 0,
+			"bundle_dependencies": 1 if held_digest is not None else 0,
+			"held_digest": frappe.as_json(held_digest.dumps()) if held_digest else None,
 		}
 	)
-	return [frappe._dict(d) for d in (docs or [])]
+	page = frappe._dict(page or {})
+	page.updates = [frappe._dict(d) for d in (page.updates or [])]
+	return page
 
 
-def get_local_doc(update):
+def get_held_digest(stream_producer):
+	"""
+	NameDigest of the local masters the subscribed doctypes link to, sent with every page request
+	when the producer bundles dependencies; None when there are too many names, masters are then
+	fetched on demand instead of bundled
+	The digest is kept in the cache between pulls and each pull only adds the masters created since
+	"""
+	doctypes = sorted(
+		{
+			doctype
+			for entry in stream_producer.producer_doctypes
+			if entry.status == "Actived" and not entry.has_mapping
+			for doctype in get_link_doctypes(entry.ref_doctype)
+		}
+	)
+	key = frappe.cache().make_key(get_held_digest_key(stream_producer.name))
+	cached = frappe.cache().get(key)
+	held = frappe._dict(frappe.parse_json(cached.decode())) if cached else None
+	if (
+		not held
+		or held.doctypes != doctypes
+		or time_diff_in_seconds(now_datetime(), held.built) > HELD_DIGEST_TTL
+	):
+		held = build_held_digest(doctypes)
+	elif held.digest:
+		add_created_masters(held)
+		if held.names > held.capacity:
+			# past its capacity the digest would answer yes for masters the consumer lacks
+			held = build_held_digest(doctypes)
+
+	frappe.cache().set(key, frappe.as_json(held), ex=HELD_DIGEST_TTL)
+	return NameDigest.loads(held.digest) if held.digest else None
+
+
+def build_held_digest(doctypes):
+	"""Cached state of a held digest of every name of the doctypes, see get_held_digest"""
+	now = str(now_datetime())
+	names = sum(frappe.db.count(doctype) for doctype in doctypes)
+	held = frappe._dict(doctypes=doctypes, built=now, updated=now, names=names, capacity=0, digest=None)
+	if names > MAX_DIGEST_NAMES:
+		return held
+
+	held.capacity = names + max(int(names * HELD_DIGEST_HEADROOM), PAGE_LENGTH)
+	digest = NameDigest.for_capacity(held.capacity)
+	for doctype in doctypes:
+		for name in frappe.get_all(doctype, pluck="name", order_by=None):
+			digest.add(doctype, name)
+	held.digest = digest.dumps()
+	return held
+
+
+def add_created_masters(held):
+	"""Add the masters created since the held digest was last updated"""
+	digest = NameDigest.loads(held.digest)
+	updated = get_datetime(held.updated)
+	since = add_to_date(updated, seconds=-HELD_DIGEST_MARGIN)
+	held.updated = str(now_datetime())
+	for doctype in held.doctypes:
+		for row in frappe.get_all(
+			doctype, filters={"creation": (">=", since)}, fields=["name", "creation"], order_by=None
+		):
+			digest.add(doctype, row.name)
+			# names within the margin were counted by the previous update
+			if get_datetime(row.creation) >= updated:
+				held.names += 1
+	held.digest = digest.dumps()
+
+
+def get_held_digest_key(producer_url):
+	return f"stream_sync_held_digest:{producer_url}"
+
+
+def get_local_doc(update, stream_producer):
 	"""Get the local document if created with a different name"""
 	try:
 		if not update.use_same_name:
-			return frappe.get_doc(update.ref_doctype, {"remote_docname": update.docname})
+			name = get_local_name(update, stream_producer)
+			return frappe.get_doc(update.ref_doctype, name) if name else None
 
 		return frappe.get_doc(update.ref_doctype, update.docname)
 	except frappe.DoesNotExistError:
 		return None
 
 
+def get_local_name(update, stream_producer):
+	"""Name of the local document of an update not named as on the producer, see set_local_names"""
+	return update.local_docname or frappe.db.get_value(
+		update.ref_doctype, {"remote_site_name": stream_producer, "remote_docname": update.docname}, "name"
+	)
+
+
+def set_local_names(updates, stream_producer):
+	"""
+	Set local_docname on the Updates and Deletes of documents not named as on the producer,
+	one query per doctype over the (remote_site_name, remote_docname) index
+	Documents the page creates are looked up one by one when they are updated
+	"""
+	by_doctype = {}
+	for update in updates:
+		if update.update_type != "Create" and not update.use_same_name and not update.local_docname:
+			by_doctype.setdefault(update.ref_doctype, []).append(update)
+
+	for doctype, pending in by_doctype.items():
+		local_names = dict(
+			frappe.get_all(
+				doctype,
+				filters={
+					"remote_site_name": stream_producer,
+					"remote_docname": ("in", list({update.docname for update in pending})),
+				},
+				fields=["remote_docname", "name"],
+				order_by=None,
+				as_list=True,
+			)
+		)
+		for update in pending:
+			update.local_docname = local_names.get(update.docname)
+
+
+def add_remote_name_index(doctype):
+	"""
+	Index the remote -> local name lookups of a doctype, unique per producer site
+	A plain index when existing documents already share a remote name
+	"""
+	if frappe.db.has_index(f"tab{doctype}", REMOTE_NAME_INDEX):
+		return
+	fields = ["remote_site_name", "remote_docname"]
+	try:
+		frappe.db.add_unique(doctype, fields, constraint_name=REMOTE_NAME_INDEX)
+	except Exception as e:
+		if not frappe.db.is_duplicate_entry(e):
+			raise
+		frappe.db.add_index(doctype, fields, index_name=REMOTE_NAME_INDEX)
+
+
 def sync_dependencies(document, producer_site, stream_producer):
 	"""
 	dependencies is a dictionary to store all the docs
@@ -478,12 +1447,14 @@ def sync_dependencies(document, producer_site, stream_producer):
 	def sync_child_table_dependencies(doc, table_fields, producer_site, stream_producer):
 		for df in table_fields:
 			child_table = doc.get(df.fieldname)
+			if not child_table:
+				continue
+			# the producer's copy of the rows when it shares the bench, else the rows as received
+			remote_rows = producer_site.get_rows(df.options, [entry.name for entry in child_table])
+			link_fields = frappe.get_meta(df.options).get_link_fields()
 			for entry in child_table:
-				# child_doc = producer_site.get_doc(entry.doctype, entry.name)
-				child_doc = get_doc_from_other_site(stream_producer, entry.doctype, entry.name)
-				if child_doc:
-					child_doc = frappe._dict(child_doc)
-					set_dependencies(child_doc, frappe.get_meta(entry.doctype).get_link_fields(), producer_site)
+				child_doc = frappe._dict(remote_rows.get(entry.name) or entry.as_dict())
+				set_dependencies(child_doc, link_fields, producer_site)
 
 	def sync_link_dependencies(doc, link_fields, producer_site):
 		set_dependencies(doc, link_fields, producer_site)
@@ -495,6 +1466,7 @@ def sync_dependencies(document, producer_site, stream_producer):
 			if docname and not check_dependency_fulfilled(linked_doctype, docname):
 				master_doc = producer_site.get_doc(linked_doctype, docname)
 				frappe.get_doc(master_doc).insert(set_name=docname)
+				producer_site.set_local(linked_doctype, docname)
 
 	def set_dependencies(doc, link_fields, producer_site):
 		for df in link_fields:
@@ -505,14 +1477,14 @@ def sync_dependencies(document, producer_site, stream_producer):
 				try:
 					master_doc = frappe.get_doc(master_doc)
 					master_doc.insert(set_name=docname, ignore_permissions=True)
-					frappe.db.commit()
+					producer_site.set_local(linked_doctype, docname)
 
 				# for dependency inside a dependency
 				except Exception:
 					dependencies[master_doc] = True
 
 	def check_dependency_fulfilled(linked_doctype, docname):
-		return frappe.db.exists(linked_doctype, docname)
+		return producer_site.exists(linked_doctype, docname)
 
 	while dependencies[document]:
 		# find the first non synced dependency
@@ -534,10 +1506,146 @@ def sync_dependencies(document, producer_site, stream_producer):
 			dependencies[document] = False
 
 
+class PullCache:
+	"""
+	Wraps the producer's FrappeClient for the duration of one pull
+	Remembers which documents exist locally and the documents fetched by name from the producer,
+	so masters shared by many updates are only checked and fetched once
+	When the producer is a site of this bench, documents are read from its database instead
+	"""
+
+	def __init__(self, producer_site):
+		self.site = producer_site
+		self.bench_site = get_bench_site(producer_site.url)
+		self.local = {}
+		self.remote = {}
+		self.installed = {}
+
+	def __getattr__(self, attr):
+		return getattr(self.site, attr)
+
+	def exists(self, doctype, name):
+		key = (doctype, name)
+		if key not in self.local:
+			self.local[key] = self.is_installed(doctype) and bool(frappe.db.exists(doctype, name))
+		return self.local[key]
+
+	def is_installed(self, doctype):
+		"""Whether the doctype exists here, Dynamic Links on the producer may name doctypes this site lacks"""
+		if doctype not in self.installed:
+			self.installed[doctype] = bool(frappe.db.exists("DocType", doctype))
+		return self.installed[doctype]
+
+	def set_local(self, doctype, name, exists=True):
+		"""Record a document the pull inserted or deleted, so later updates of the page see it"""
+		self.local[(doctype, name)] = exists
+
+	def forget_local(self):
+		self.local.clear()
+
+	def get_doc(self, doctype, name="", filters=None, fields=None):
+		if filters or fields or not name:
+			return self.site.get_doc(doctype, name, filters=filters, fields=fields)
+
+		key = (doctype, name)
+		if key not in self.remote and self.bench_site:
+			self.read_bench(lambda bench_site: self.remote.update(bench_site.get_docs(doctype, [name])))
+		if key not in self.remote:
+			self.remote[key] = self.site.get_doc(doctype, name)
+		# callers build Documents from the result, hand out a copy
+		return copy.deepcopy(self.remote[key])
+
+	def get_rows(self, doctype, names):
+		"""Rows of the doctype by name as stored on the producer, empty unless it shares this bench"""
+		if not self.bench_site:
+			return {}
+		return self.read_bench(lambda bench_site: bench_site.get_rows(doctype, names)) or {}
+
+	def read_bench(self, read):
+		"""
+		Run a read against the producer's database, on failure log it and read over HTTP
+		for the rest of the pull, BenchSite reconnects on the next pull
+		"""
+		try:
+			return read(self.bench_site)
+		except Exception:
+			frappe.log_error(title=_("Stream Sync: reading producer database failed, using the API"))
+			self.bench_site = None
+
+	def forget_remote(self, doctypes):
+		"""
+		Drop the documents of `doctypes` fetched for a page, the whole documents of amend mode
+		"Update Source" are fetched again for every page so later producer changes are applied
+		"""
+		for key in [key for key in self.remote if key[0] in doctypes]:
+			del self.remote[key]
+
+	def add_docs(self, docs):
+		"""Keep documents the producer sent along with a page, see get_update_log_page"""
+		for doc in docs or []:
+			self.remote[(doc.get("doctype"), doc.get("name"))] = doc
+
+	def prefetch_links(self, updates, source_doctypes=()):
+		"""
+		Collect the masters the updates link to that are missing locally and fetch them with get_docs,
+		along with the whole remote document of updates to `source_doctypes` (amend mode "Update Source")
+		"""
+		missing = set()
+		for update in updates:
+			if update.update_type == "Delete" or update.mapping:
+				continue
+			if update.update_type == "Update" and update.ref_doctype in source_doctypes:
+				missing.add((update.ref_doctype, update.docname))
+			missing.update(get_update_links(update.ref_doctype, update.update_type, update.data))
+
+		# links to doctypes not installed here are left to fail with their update
+		missing = [
+			key
+			for key in missing
+			if key not in self.remote
+			and self.is_installed(key[0])
+			and (key[0] in source_doctypes or not self.exists(*key))
+		]
+		if not missing:
+			return
+
+		if self.bench_site:
+			by_doctype = {}
+			for doctype, name in missing:
+				by_doctype.setdefault(doctype, []).append(name)
+
+			def read(bench_site):
+				for doctype, names in by_doctype.items():
+					self.remote.update(bench_site.get_docs(doctype, names))
+				return True
+
+			if self.read_bench(read):
+				return
+			missing = [key for key in missing if key not in self.remote]
+			if not missing:
+				return
+
+		def fetch(keys):
+			try:
+				return keys, get_remote_docs(self.site, [{"doctype": dt, "name": name} for dt, name in keys])
+			except Exception:
+				# left to be fetched on demand, where the error is reported with the update
+				return keys, [None] * len(keys)
+
+		chunks = [
+			missing[i : i + DOC_REQUESTS_PER_CALL] for i in range(0, len(missing), DOC_REQUESTS_PER_CALL)
+		]
+		with ThreadPoolExecutor(max_workers=min(PREFETCH_WORKERS, len(chunks))) as executor:
+			for keys, docs in executor.map(fetch, chunks):
+				for key, doc in zip(keys, docs, strict=True):
+					if doc:
+						self.remote[key] = doc
+
+
 def sync_mapped_dependencies(dependencies, producer_site):
 	dependencies_created = {}
 	for entry in dependencies:
-		doc = frappe._dict(json.loads(entry[1]))
+		doc = frappe._dict(frappe.parse_json(entry[1]))
 		docname = frappe.db.exists(doc.doctype, doc.name)
 		if not docname:
 			doc = frappe.get_doc(doc).insert(set_child_names=False)
@@ -548,62 +1656,69 @@ def sync_mapped_dependencies(dependencies, producer_site):
 	return dependencies_created
 
 
-def log_stream_sync(update, stream_producer, sync_status, error=None):
+def log_stream_sync(update, stream_producer, sync_status, error=None, logs=None):
 	"""Log stream update received with the sync_status as Synced or Failed"""
+	if logs is not None:
+		logs.add(update, sync_status, error)
+	else:
+		get_sync_log(update, stream_producer, sync_status, error).insert()
+
+
+def get_sync_log(update, stream_producer, sync_status, error=None, data_format="Full"):
 	doc = frappe.new_doc("Stream Sync Log")
 	doc.update_type = update.update_type
 	doc.ref_doctype = update.ref_doctype
 	doc.status = sync_status
 	doc.stream_producer = stream_producer
 	doc.producer_doc = update.docname
-	doc.data = frappe.as_json(update.data)
+	doc.data = encode_log_data(update.data, sync_status, data_format)
 	doc.use_same_name = update.use_same_name
 	doc.mapping = update.mapping if update.mapping else None
 	if update.use_same_name:
 		doc.docname = update.docname
 	else:
-		doc.docname = frappe.db.get_value(update.ref_doctype, {"remote_docname": update.docname}, "name")
+		doc.docname = get_local_name(update, stream_producer)
 	if error:
 		doc.error = error
-	doc.insert()
+	return doc
 
 
 def get_mapped_update(update, producer_site):
 	"""get the new update document with mapped fields"""
-	mapping = frappe.get_doc("Doctype Mapping", update.mapping)
+	plan = get_mapping_plan(update.mapping)
 	if update.update_type == "Create":
-		doc = frappe._dict(json.loads(update.data))
-		mapped_update = mapping.get_mapping(doc, producer_site, update.update_type)
-		update.data = mapped_update.get("doc")
-		update.dependencies = mapped_update.get("dependencies", None)
+		doc = frappe._dict(frappe.parse_json(update.data))
+		update.data, update.dependencies = plan.map_doc(doc, producer_site, update.update_type)
 	elif update.update_type == "Update":
-		mapped_update = mapping.get_mapped_update(update, producer_site)
-		update.data = mapped_update.get("doc")
-		update.dependencies = mapped_update.get("dependencies", None)
+		update.data, update.dependencies = plan.map_update(frappe.parse_json(update.data), producer_site)
 
-	update["ref_doctype"] = mapping.local_doctype
+	update["ref_doctype"] = plan.local_doctype
 	return update
 
 
 @frappe.whitelist()
 def new_stream_notification(producer_url):
 	"""Pull data from producer when notified"""
-	enqueued_method = "stream_sync.stream_sync.doctype.stream_producer.stream_producer.pull_from_node"
-	jobs = get_jobs()
-	if not jobs or enqueued_method not in jobs[frappe.local.site]:
-		frappe.enqueue(enqueued_method, queue="default", **{"stream_producer": producer_url})
+	# a burst of notifications from the same producer shares one pull
+	enqueue_pull(producer_url)
+
+
+def get_pull_debounce_key(producer_url, suffix=None):
+	return f"stream_sync_pull:{producer_url}:{suffix}" if suffix else f"stream_sync_pull:{producer_url}"
 
 
 @frappe.whitelist()
 def resync(update):
 	"""Retry syncing update if failed"""
 	update = frappe._dict(json.loads(update))
-	producer_site = get_producer_site(update.stream_producer)
+	update.data = decode_log_data(update.data)
+	producer_site = PullCache(get_producer_site(update.stream_producer))
 	stream_producer = frappe.get_doc("Stream Producer", update.stream_producer)
+	context = PullContext(stream_producer)
 	if update.mapping:
 		update = get_mapped_update(update, producer_site)
-		update.data = json.loads(update.data)
-	return sync(update, producer_site, stream_producer, in_retry=True)
+		update.data = frappe.parse_json(update.data)
+	return sync(update, producer_site, stream_producer, in_retry=True, context=context)
 
 
 def check_amended_from(doc, producer_site):
@@ -613,57 +1728,6 @@ def check_amended_from(doc, producer_site):
 	return doc.get('name')
 
 
-def replace_all_child_rows(local_doc, changed):
-	"""Ganti semua child table rows dan insert ulang ke database.
-	   Hapus dulu record lama berdasarkan parent agar tidak duplicate entry."""
-	for tablename, rows in changed.items():
-		# Lewati jika rows bukan list
-		if not isinstance(rows, (list, tuple)):
-			continue
-
-		# Pastikan field adalah child table
-		table_field = next(
-			(f for f in local_doc.meta.fields if f.fieldtype == "Table" and f.fieldname == tablename),
-			None
-		)
-		if not table_field:
-			continue
-
-		# Dapatkan nama doctype child-nya
-		child_doctype = table_field.options
-
-		# Hapus semua record lama di database untuk parent ini
-		try:
-			frappe.db.delete(child_doctype, {"parent": local_doc.name})
-		except Exception as e:
-			frappe.log_error(f"Error deleting old child rows for {child_doctype}: {str(e)}")
-			continue
-
-		# Kosongkan child table di memori
-		local_doc.set(tablename, [])
-
-		# Tambahkan dan insert setiap baris baru ke DB
-		for row in rows:
-			if not isinstance(row, dict):
-				continue
-
-			try:
-				# Tambahkan ke child table di memori
-				local_doc.append(tablename, row)
-
-				# Insert langsung ke database
-				child_doc = frappe.get_doc(row)
-				child_doc.parent = local_doc.name
-				child_doc.parenttype = local_doc.doctype
-				child_doc.parentfield = tablename
-				child_doc.insert(ignore_permissions=True, set_name=child_doc.name)
-			except Exception as e:
-				frappe.log_error(f"Error inserting child row in {child_doctype}: {str(e)}")
-				continue
-
-	return local_doc
-
-
 def update_non_table_fields(local_doc, changed):
 	"""Update only non-table fields in local_doc based on changed data, skipping system fields."""
 	system_fields = {"creation", "modified","owner", "idx", "doctype", "name", "docstatus"}
@@ -687,14 +1751,16 @@ def update_non_table_fields(local_doc, changed):
 
 	return local_doc
 
-def mapping_data(local_doc, mapping_name):
+def mapping_data(local_doc, mapping_name, mappings=None):
+	"""Lakukan mapping data ke local_doc secara rekursif berdasarkan Doctype Mapping"""
 	# kalau mappingnya kosong, retur
+	if not mapping_name:
+		return local_doc
 
-	if not mapping:
-		return
-
-	"""Lakukan mapping data ke local_doc secara rekursif berdasarkan Doctype Mapping"""
-	mapping_doc = frappe.get_doc("Doctype Mapping", mapping_name)
+	if mappings and mapping_name in mappings:
+		mapping_doc = mappings[mapping_name]
+	else:
+		mapping_doc = frappe.get_doc("Doctype Mapping", mapping_name)
 
 	for m in mapping_doc.field_mapping:
 		if not m.mapping_type or m.mapping_type == "":
@@ -716,10 +1782,10 @@ def mapping_data(local_doc, mapping_name):
 				child_table = getattr(local_doc, m.local_fieldname)
 				if isinstance(child_table, list):
 					for child_row in child_table:
-						mapping_data(child_row, m.mapping)
+						mapping_data(child_row, m.mapping, mappings)
 
 		elif m.mapping_type == "Document":
-			mapping_data(local_doc, m.mapping)
+			mapping_data(local_doc, m.mapping, mappings)
 
 	return local_doc
 
@@ -731,47 +1797,3 @@ def get_docstatus_target(target_docstatus):
 		"Follow Source": 3
 	}
 	return docstatus[target_docstatus]
-
-import frappe, re
-
-def get_doc_from_other_site(site_url_or_name, doctype, docname):
-	"""
-	Mengambil dokumen dari site lain tanpa menggunakan FrappeClient.
-	Fungsi ini langsung membaca database site lain menggunakan frappe.init() + frappe.connect().
-	
-	Args:
-		site_url_or_name (str): Nama site atau URL site producer (misal: 'producer.site.com' atau 'https://producer.site.com')
-		doctype (str): Nama Doctype dokumen yang ingin diambil
-		docname (str): Nama dokumen (name) yang ingin diambil
-
-	Returns:
-		Document: frappe.model.document.Document dari site target
-	"""
-	current_site = frappe.local.site  # simpan site aktif sekarang
-	try:
-		# Hilangkan protokol jika ada
-		site_name = re.sub(r"^https?://", "", site_url_or_name).strip("/")
-
-		# Inisialisasi dan koneksi ke site target
-		frappe.destroy()
-		frappe.init(site_name)
-		frappe.connect()
-
-		# Abaikan permission
-		frappe.flags.ignore_permissions = True
-
-		# Ambil dokumen
-		doc = frappe.db.get_value(doctype, docname, "*", as_dict=1)
-		return doc
-
-	except Exception as e:
-		frappe.log_error(f"Error saat mengambil dokumen {doctype} - {docname} dari site {site_name}: {e}", "get_doc_from_other_site")
-		raise
-
-	finally:
-		# Tutup koneksi site target
-		frappe.destroy()
-
-		# Kembalikan ke site semula
-		frappe.init(current_site)
-		frappe.connect()
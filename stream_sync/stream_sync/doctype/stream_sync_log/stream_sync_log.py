@@ -1,9 +1,58 @@
 # Copyright (c) 2025, Jufer and contributors
 # For license information, please see license.txt
 
-# import frappe
+import base64
+import zlib
+
+import frappe
 from frappe.model.document import Document
+from frappe.utils import add_days, now_datetime
+
+from stream_sync.utils import purge_logs
+
+# marks data stored as base64 of zlib, see encode_log_data
+COMPRESSED_PREFIX = "zlib:"
+
+# characters of data kept by the Truncated Sync Log Data of a Stream Producer
+TRUNCATED_DATA_LENGTH = 1000
 
 
 class StreamSyncLog(Document):
-	pass
+	def onload(self):
+		self.data = decode_log_data(self.data)
+
+
+def encode_log_data(data, status, data_format="Full"):
+	"""The data of an update as stored in its log, see the Sync Log Data of a Stream Producer"""
+	if data_format == "Full":
+		return frappe.as_json(data)
+
+	text = frappe.as_json(data, indent=None, separators=(",", ":"))
+	if data_format == "Truncated" and status == "Synced":
+		return text[:TRUNCATED_DATA_LENGTH]
+	return COMPRESSED_PREFIX + base64.b64encode(zlib.compress(text.encode())).decode()
+
+
+def decode_log_data(data):
+	if isinstance(data, str) and data.startswith(COMPRESSED_PREFIX):
+		return zlib.decompress(base64.b64decode(data[len(COMPRESSED_PREFIX) :])).decode()
+	return data
+
+
+def purge_sync_logs():
+	"""Scheduled daily, synced and failed logs have their own retention"""
+	settings = frappe.get_single("Stream Sync Settings")
+	for status, days in (
+		("Synced", settings.synced_log_retention_days),
+		("Failed", settings.failed_log_retention_days),
+	):
+		if days:
+			purge_logs(
+				"Stream Sync Log",
+				{"status": status, "creation": ("<", add_days(now_datetime(), -days))},
+				settings,
+			)
+
+
+def on_doctype_update():
+	frappe.db.add_index("Stream Sync Log", ["status", "creation"])
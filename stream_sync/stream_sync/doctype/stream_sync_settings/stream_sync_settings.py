@@ -0,0 +1,12 @@
+# Copyright (c) 2026, Jufer and contributors
+# For license information, please see license.txt
+
+from frappe.model.document import Document
+
+from stream_sync.utils import REMOTE_CLIENTS_VERSION_KEY, bump_cache_version
+
+
+class StreamSyncSettings(Document):
+	def on_update(self):
+		# the cached remote clients carry the connection settings
+		bump_cache_version(REMOTE_CLIENTS_VERSION_KEY)
@@ -1,23 +1,56 @@
 # Copyright (c) 2025, Jufer and contributors
 # For license information, please see license.txt
 
+import time
+from functools import partial
+
 import frappe
 from frappe.model import no_value_fields, table_fields
 from frappe.model.document import Document
-from frappe.utils.background_jobs import get_jobs
+from frappe.utils import add_days, cint, get_datetime, now_datetime
+
+from stream_sync.stream_sync.doctype.stream_delivery_ledger.stream_delivery_ledger import mark_delivered
+from stream_sync.utils import (
+	NameDigest,
+	bump_cache_version,
+	debounce,
+	get_cache_version,
+	get_links,
+	get_update_links,
+	purge_logs,
+)
+
+# page size used when the consumer does not ask for one, and the upper bound it may ask for
+DEFAULT_PAGE_LENGTH = 500
+MAX_PAGE_LENGTH = 5000
+
+# levels of links followed when bundling dependencies, see get_dependency_bundle
+DEPENDENCY_BUNDLE_DEPTH = 3
+
+# expiry of the notification debounce key, frees it if the queued job is lost
+NOTIFY_DEBOUNCE_TTL = 60
+
 
 class StreamUpdateLog(Document):
 	def after_insert(self):
 		"""Send update notification updates to Stream consumers
 		whenever update log is generated"""
-		enqueued_method = (
-			"stream_sync.stream_sync.doctype.stream_consumer.stream_consumer.notify_stream_consumers"
+		# claimed once the log is committed, a rolled back log must not hold the claim
+		frappe.db.after_commit.add(partial(enqueue_notify_consumers, self.ref_doctype))
+
+
+def enqueue_notify_consumers(doctype):
+	"""Queue notify_stream_consumers, a burst of logs of the same doctype shares one job"""
+	if debounce(get_notify_debounce_key(doctype), NOTIFY_DEBOUNCE_TTL):
+		frappe.enqueue(
+			"stream_sync.stream_sync.doctype.stream_consumer.stream_consumer.notify_stream_consumers",
+			doctype=doctype,
+			queue="long",
 		)
-		jobs = get_jobs()
-		if not jobs or enqueued_method not in jobs[frappe.local.site]:
-			frappe.enqueue(
-				enqueued_method, doctype=self.ref_doctype, queue="long", enqueue_after_commit=True
-			)
+
+
+def get_notify_debounce_key(doctype):
+	return f"stream_sync_notify_consumers:{doctype}"
 
 
 def notify_consumers(doc, event):
@@ -41,18 +74,53 @@ def notify_consumers(doc, event):
 					doc.diff = diff
 					make_stream_update_log(doc, update_type="Update")
 
-ENABLED_DOCTYPES_CACHE_KEY = "stream_sync_enabled_doctypes"
+SUBSCRIBED_DOCTYPES_VERSION_KEY = "stream_sync_subscribed_doctypes_version"
 
-def check_doctype_has_consumers(doctype: str) -> bool:
-	"""Check if doctype has Stream consumers for event streaming"""
-	def fetch_from_db():
-		return frappe.get_all(
-			"Stream Consumer Doctype",
-			filters={"ref_doctype": doctype, "status": "Actived", "unsubscribe": 0, "stream_type": "Event"},
-			ignore_ddl=True,
+# seconds a process trusts its subscribed doctypes before checking the version token in Redis again
+SUBSCRIBED_DOCTYPES_CHECK_INTERVAL = 5
+
+# doctypes with Stream consumers per site, with the version token they were loaded at
+# and the time.monotonic() it was last checked at
+subscribed_doctypes = {}
+
+
+def get_subscribed_doctypes():
+	"""
+	Doctypes with Stream consumers for event streaming, kept in process memory
+	The version token is read from Redis at most every SUBSCRIBED_DOCTYPES_CHECK_INTERVAL seconds,
+	other processes see a subscription change within that time, see clear_subscribed_doctypes
+	"""
+	cached = subscribed_doctypes.get(frappe.local.site)
+	checked = time.monotonic()
+	if cached and checked - cached[1] < SUBSCRIBED_DOCTYPES_CHECK_INTERVAL:
+		return cached[2]
+
+	version = get_cache_version(SUBSCRIBED_DOCTYPES_VERSION_KEY)
+	if cached and cached[0] == version:
+		doctypes = cached[2]
+	else:
+		doctypes = frozenset(
+			frappe.get_all(
+				"Stream Consumer Doctype",
+				filters={"status": "Actived", "unsubscribe": 0, "stream_type": "Event"},
+				pluck="ref_doctype",
+				distinct=True,
+				ignore_ddl=True,
+			)
 		)
+	subscribed_doctypes[frappe.local.site] = (version, checked, doctypes)
+	return doctypes
 
-	return bool(frappe.cache().hget(ENABLED_DOCTYPES_CACHE_KEY, doctype, fetch_from_db))
+
+def clear_subscribed_doctypes():
+	"""Reload the subscribed doctypes in this process now and in the others within the check interval"""
+	subscribed_doctypes.pop(frappe.local.site, None)
+	bump_cache_version(SUBSCRIBED_DOCTYPES_VERSION_KEY)
+
+
+def check_doctype_has_consumers(doctype: str) -> bool:
+	"""Check if doctype has Stream consumers for event streaming"""
+	return doctype in get_subscribed_doctypes()
 
 
 def get_update(old, new, for_child=False):
@@ -74,20 +142,15 @@ def get_update(old, new, for_child=False):
 	if not new:
 		return None
 
+	plan = get_diff_plan(new.meta)
 	out = frappe._dict(changed={}, added={}, removed={}, row_changed={})
-	for df in new.meta.fields:
-		if df.fieldtype in no_value_fields and df.fieldtype not in table_fields:
-			continue
-
-		old_value, new_value = old.get(df.fieldname), new.get(df.fieldname)
-
-		if df.fieldtype in table_fields:
-			old_row_by_name, new_row_by_name = make_maps(old_value, new_value)
-			out = check_for_additions(out, df, new_value, old_row_by_name)
-			out = check_for_deletions(out, df, old_value, new_row_by_name)
+	for fieldname in plan.value_fields:
+		new_value = new.get(fieldname)
+		if old.get(fieldname) != new_value:
+			out.changed[fieldname] = new_value
 
-		elif old_value != new_value:
-			out.changed[df.fieldname] = new_value
+	for fieldname in plan.table_fields:
+		diff_table(out, fieldname, old.get(fieldname) or [], new.get(fieldname) or [])
 
 	out = check_docstatus(out, old, new, for_child)
 	if any((out.changed, out.added, out.removed, out.row_changed)):
@@ -95,6 +158,25 @@ def get_update(old, new, for_child=False):
 	return None
 
 
+def get_diff_plan(meta):
+	"""
+	Fieldnames get_update compares for a doctype, computed once and kept on the meta
+	like its other lazily computed properties
+	"""
+	plan = getattr(meta, "_stream_sync_diff_plan", None)
+	if plan is None:
+		value_fields, table_fieldnames = [], []
+		for df in meta.fields:
+			if df.fieldtype in table_fields:
+				table_fieldnames.append(df.fieldname)
+			elif df.fieldtype not in no_value_fields:
+				value_fields.append(df.fieldname)
+
+		plan = frappe._dict(value_fields=tuple(value_fields), table_fields=tuple(table_fieldnames))
+		meta._stream_sync_diff_plan = plan
+	return plan
+
+
 def make_stream_update_log(doc, update_type):
 	"""Save update info for doctypes that have Stream consumers"""
 	if update_type != "Delete":
@@ -113,40 +195,41 @@ def make_stream_update_log(doc, update_type):
 	).insert(ignore_permissions=True)
 
 
-def make_maps(old_value, new_value):
-	"""make maps"""
-	old_row_by_name, new_row_by_name = {}, {}
-	for d in old_value:
-		old_row_by_name[d.name] = d
-	for d in new_value:
-		new_row_by_name[d.name] = d
-	return old_row_by_name, new_row_by_name
-
-
-def check_for_additions(out, df, new_value, old_row_by_name):
-	"""check rows for additions, changes"""
-	for _i, d in enumerate(new_value):
-		if d.name in old_row_by_name:
-			diff = get_update(old_row_by_name[d.name], d, for_child=True)
-			if diff and diff.changed:
-				if not out.row_changed.get(df.fieldname):
-					out.row_changed[df.fieldname] = []
-				diff.changed["name"] = d.name
-				out.row_changed[df.fieldname].append(diff.changed)
-		else:
-			if not out.added.get(df.fieldname):
-				out.added[df.fieldname] = []
-			out.added[df.fieldname].append(d.as_dict())
-	return out
+def diff_table(out, fieldname, old_rows, new_rows):
+	"""
+	Add the added, removed and changed rows of a child table to the diff
+	Rows are matched by name and compared through the tuple of their values, so only rows
+	that really changed are diffed field by field
+	"""
+	old_row_by_name = {d.name: d for d in old_rows}
+	new_names = set()
+	value_fields = None
+
+	for d in new_rows:
+		new_names.add(d.name)
+		old_row = old_row_by_name.get(d.name)
+		if old_row is None:
+			out.added.setdefault(fieldname, []).append(d.as_dict())
+			continue
+
+		if value_fields is None:
+			value_fields = get_diff_plan(d.meta).value_fields
 
+		old_values = tuple(old_row.get(f) for f in value_fields)
+		new_values = tuple(d.get(f) for f in value_fields)
+		if old_values != new_values:
+			changed = {
+				f: value
+				for f, old_value, value in zip(value_fields, old_values, new_values, strict=True)
+				if old_value != value
+			}
+			changed["name"] = d.name
+			out.row_changed.setdefault(fieldname, []).append(changed)
+
+	for d in old_rows:
+		if d.name not in new_names:
+			out.removed.setdefault(fieldname, []).append(d.name)
 
-def check_for_deletions(out, df, old_value, new_row_by_name):
-	"""check for deletions"""
-	for d in old_value:
-		if d.name not in new_row_by_name:
-			if not out.removed.get(df.fieldname):
-				out.removed[df.fieldname] = []
-			out.removed[df.fieldname].append(d.name)
 	return out
 
 
@@ -157,143 +240,400 @@ def check_docstatus(out, old, new, for_child):
 	return out
 
 
-def is_consumer_uptodate(update_log, consumer):
+def get_unread_update_logs(consumer_name, keys, last_update, last_name=None):
 	"""
-	Checks if Consumer has read all the UpdateLogs before the specified update_log
-	:param update_log: The UpdateLog Doc in context
-	:param consumer: The EventConsumer doc
+	Get old logs unread by the consumer on the given documents, up to and including the cursor
+	Only logs newer than the consumer's delivery watermark of each document are read,
+	the watermark is applied by the database so delivered history is never loaded
+	:param keys: iterable of (ref_doctype, docname)
+	:return: dict of (ref_doctype, docname) -> logs in cursor order
 	"""
-	if update_log.update_type == "Create":
-		# consumer is obviously up to date
-		return True
-
-	prev_logs = frappe.get_all(
-		"Stream Update Log",
-		filters={
-			"ref_doctype": update_log.ref_doctype,
-			"docname": update_log.docname,
-			"creation": ["<", update_log.creation],
-		},
-		order_by="creation desc",
-		limit_page_length=1,
-	)
+	keys = set(keys)
+	if not keys:
+		return {}
 
-	if not len(prev_logs):
-		return False
+	names_by_doctype = {}
+	for ref_doctype, docname in keys:
+		names_by_doctype.setdefault(ref_doctype, []).append(docname)
 
-	prev_log_consumers = frappe.get_all(
-		"Stream Update Log Consumer",
-		fields=["consumer"],
-		filters={
-			"parent": prev_logs[0].name,
-			"parenttype": "Stream Update Log",
-			"consumer": consumer.name,
-		},
-	)
+	if last_name:
+		cursor_condition = "(log.creation < %(last_update)s OR (log.creation = %(last_update)s AND log.name <= %(last_name)s))"
+	else:
+		cursor_condition = "log.creation <= %(last_update)s"
+
+	unread = {}
+	for ref_doctype, docnames in names_by_doctype.items():
+		logs = frappe.db.sql(
+			f"""
+			SELECT log.update_type, log.ref_doctype, log.docname, log.data, log.name, log.creation
+			FROM `tabStream Update Log` log
+			LEFT JOIN `tabStream Delivery Ledger` ledger
+				ON ledger.consumer = %(consumer)s
+				AND ledger.ref_doctype = log.ref_doctype
+				AND ledger.docname = log.docname
+			WHERE log.ref_doctype = %(ref_doctype)s
+				AND log.docname IN %(docnames)s
+				AND {cursor_condition}
+				AND (
+					ledger.name IS NULL
+					OR log.creation > ledger.last_update_creation
+					OR (log.creation = ledger.last_update_creation AND log.name > ledger.last_update_log)
+				)
+			ORDER BY log.creation, log.name
+		""",
+			{
+				"consumer": consumer_name,
+				"ref_doctype": ref_doctype,
+				"docnames": tuple(docnames),
+				"last_update": last_update,
+				"last_name": last_name,
+			},
+			as_dict=True,
+		)
+		for d in logs:
+			unread.setdefault((d.ref_doctype, d.docname), []).append(d)
 
-	return len(prev_log_consumers) > 0
+	return unread
 
 
-def mark_consumer_read(update_log_name, consumer_name):
+def get_update_logs_after(doctypes, last_update, last_name=None, limit=None, sql_conditions=None):
 	"""
-	This function appends the Consumer to the list of Consumers that has 'read' an Update Log
+	Get Stream Update Logs of the given doctypes positioned after the (creation, name) cursor,
+	in ascending cursor order
+	:param sql_conditions: dict of doctype -> compiled consumer condition with filters,
+		logs of documents the filters reject are left out by the database (Delete logs are always kept),
+		the others are still checked with get_consumer_access
 	"""
-	update_log = frappe.get_doc("Stream Update Log", update_log_name)
-	if len([x for x in update_log.consumers if x.consumer == consumer_name]):
-		return
-
-	frappe.get_doc(
-		frappe._dict(
-			doctype="Stream Update Log Consumer",
-			consumer=consumer_name,
-			parent=update_log_name,
-			parenttype="Stream Update Log",
-			parentfield="consumers",
+	if not doctypes:
+		return []
+
+	sql_conditions = sql_conditions or {}
+	values = {"last_update": last_update, "last_name": last_name, "limit": limit}
+
+	doctype_conditions = []
+	plain_doctypes = [dt for dt in doctypes if dt not in sql_conditions]
+	if plain_doctypes:
+		values["doctypes"] = tuple(plain_doctypes)
+		doctype_conditions.append("ref_doctype IN %(doctypes)s")
+
+	for i, (doctype, compiled) in enumerate(sql_conditions.items()):
+		visible_names = frappe.get_all(
+			doctype,
+			filters=[list(f) for f in compiled.filters],
+			or_filters=[list(f) for f in compiled.or_filters],
+			fields=["name"],
+			run=0,
 		)
-	).insert(ignore_permissions=True)
-
-
-def get_unread_update_logs(consumer_name, dt, dn):
-	"""
-	Get old logs unread by the consumer on a particular document
-	"""
-	already_consumed = [
-		x[0]
-		for x in frappe.db.sql(
-			"""
-		SELECT
-			update_log.name
-		FROM `tabStream Update Log` update_log
-		JOIN `tabStream Update Log Consumer` consumer ON consumer.parent = %(log_name)s
-		WHERE
-			consumer.consumer = %(consumer)s
-			AND update_log.ref_doctype = %(dt)s
-			AND update_log.docname = %(dn)s
-	""",
-			{
-				"consumer": consumer_name,
-				"dt": dt,
-				"dn": dn,
-				"log_name": "update_log.name"
-				if frappe.conf.db_type == "mariadb"
-				else "CAST(update_log.name AS VARCHAR)",
-			},
-			as_dict=0,
+		values[f"doctype_{i}"] = doctype
+		# values are already escaped in the subquery, only protect its % from parameter formatting
+		doctype_conditions.append(
+			f"(ref_doctype = %(doctype_{i})s AND (update_type = 'Delete' OR docname IN ({visible_names.replace('%', '%%')})))"
 		)
-	]
 
-	logs = frappe.get_all(
-		"Stream Update Log",
-		fields=["update_type", "ref_doctype", "docname", "data", "name", "creation"],
-		filters={"ref_doctype": dt, "docname": dn, "name": ["not in", already_consumed]},
-		order_by="creation",
+	if last_name:
+		cursor_condition = (
+			"(creation > %(last_update)s OR (creation = %(last_update)s AND name > %(last_name)s))"
+		)
+	else:
+		cursor_condition = "creation > %(last_update)s"
+
+	return frappe.db.sql(
+		f"""
+		SELECT update_type, ref_doctype, docname, data, name, creation
+		FROM `tabStream Update Log`
+		WHERE ({" OR ".join(doctype_conditions)})
+			AND {cursor_condition}
+		ORDER BY creation, name
+		{"LIMIT %(limit)s" if limit else ""}
+	""",
+		values,
+		as_dict=True,
 	)
 
-	return logs
-
 
 @frappe.whitelist()
-def get_update_logs_for_consumer(stream_consumer, doctypes, last_update):
+def get_update_log_page(
+	stream_consumer,
+	doctypes,
+	last_update,
+	last_name=None,
+	page_length=None,
+	compact=False,
+	bundle_dependencies=False,
+	held_digest=None,
+):
 	"""
-	Fetches all the UpdateLogs for the consumer
+	Fetches one page of UpdateLogs for the consumer after the (last_update, last_name) cursor
+	Returns the served updates, the cursor to request the next page with and a has_more flag
 	It will inject old un-consumed Update Logs if a doc was just found to be accessible to the Consumer
+	:param compact: merge the logs of each document in the page, see compact_update_logs
+	:param bundle_dependencies: also return the documents the updates link to, see get_dependency_bundle
+	:param held_digest: NameDigest of the masters the consumer already holds
 	"""
-
 	if isinstance(doctypes, str):
 		doctypes = frappe.parse_json(doctypes)
 
-	from stream_sync.stream_sync.doctype.stream_consumer.stream_consumer import has_consumer_access
+	frappe.has_permission("Stream Update Log", "read", throw=True)
+
+	from stream_sync.stream_sync.doctype.stream_consumer.stream_consumer import (
+		get_consumer_access,
+		get_sql_conditions,
+	)
 
+	page_length = min(cint(page_length) or DEFAULT_PAGE_LENGTH, MAX_PAGE_LENGTH)
 	consumer = frappe.get_doc("Stream Consumer", stream_consumer)
-	docs = frappe.get_list(
-		doctype="Stream Update Log",
-		filters={"ref_doctype": ("in", doctypes), "creation": (">", last_update)},
-		fields=["update_type", "ref_doctype", "docname", "data", "name", "creation"],
-		order_by="creation desc",
+	if last_update:
+		# the consumer has applied everything before the cursor it asks from, see purge_update_logs
+		frappe.db.set_value(
+			"Stream Consumer", consumer.name, "last_update", last_update, update_modified=False
+		)
+
+	# fetch one extra row to know if there is a next page
+	page = get_update_logs_after(
+		doctypes,
+		last_update,
+		last_name,
+		limit=page_length + 1,
+		sql_conditions=get_sql_conditions(consumer, doctypes),
+	)
+	has_more = len(page) > page_length
+	page = page[:page_length]
+
+	access = get_consumer_access(consumer, page)
+	docs = [d for d, allowed in zip(page, access, strict=True) if allowed]
+
+	# a document whose first log in this page is not a Create may have history the consumer never got,
+	# e.g. when it just became accessible; inject those old logs ahead of it
+	first_logs = {}
+	for d in docs:
+		first_logs.setdefault((d.ref_doctype, d.docname), d)
+	history = get_unread_update_logs(
+		consumer.name,
+		[key for key, d in first_logs.items() if d.update_type != "Create"],
+		last_update,
+		last_name,
 	)
 
 	result = []
-	to_update_history = []
 	for d in docs:
-		if (d.ref_doctype, d.docname) in to_update_history:
-			# will be notified by background jobs
-			continue
+		key = (d.ref_doctype, d.docname)
+		if first_logs.get(key) is d:
+			result.extend(history.get(key, []))
+		result.append(d)
 
-		if not has_consumer_access(consumer=consumer, update_log=d):
-			continue
+	mark_delivered(consumer.name, result)
+
+	if cint(compact):
+		result = compact_update_logs(result)
 
-		if not is_consumer_uptodate(d, consumer):
-			to_update_history.append((d.ref_doctype, d.docname))
-			# get_unread_update_logs will have the current log
-			old_logs = get_unread_update_logs(consumer.name, d.ref_doctype, d.docname)
-			if old_logs:
-				old_logs.reverse()
-				result.extend(old_logs)
+	# the cursor also moves past logs this consumer has no access to
+	if page:
+		last_update, last_name = str(page[-1].creation), page[-1].name
+
+	response = {
+		"updates": result,
+		"last_update": last_update,
+		"last_name": last_name,
+		"has_more": has_more,
+	}
+	if cint(bundle_dependencies):
+		response["dependencies"] = get_dependency_bundle(result, held_digest)
+	return response
+
+
+def get_dependency_bundle(update_logs, held_digest=None):
+	"""
+	Documents the logs link to, child rows included, and the documents those link to,
+	up to DEPENDENCY_BUNDLE_DEPTH levels; each appears once however many logs need it
+	Documents in the consumer's held digest and documents the user can not read are left out
+	"""
+	held = NameDigest.loads(held_digest) if held_digest else None
+
+	pending = set()
+	for log in update_logs:
+		if log.update_type != "Delete":
+			pending.update(get_update_links(log.ref_doctype, log.update_type, frappe.parse_json(log.data)))
+
+	bundle = {}
+	for _level in range(DEPENDENCY_BUNDLE_DEPTH):
+		pending = {key for key in pending if key not in bundle and not (held and key in held)}
+		linked = set()
+		for doctype, name in pending:
+			if not frappe.db.exists(doctype, name):
+				continue
+			doc = frappe.get_doc(doctype, name)
+			if not frappe.has_permission(doctype, "read", doc):
+				continue
+			doc.apply_fieldlevel_read_permissions()
+			bundle[(doctype, name)] = doc.as_dict()
+			linked.update(get_links(doctype, bundle[(doctype, name)]))
+		pending = linked
+
+	return list(bundle.values())
+
+
+def compact_update_logs(update_logs):
+	"""
+	Merge the logs of each document so the consumer applies one update instead of many
+	- consecutive Updates become one Update with the combined diff
+	- a Create followed by Updates becomes one Create of the latest state
+	- a Create followed by a Delete cancels out, Updates followed by a Delete become the Delete
+	- Updates that change docstatus are kept apart, the consumer has to submit or cancel step by step
+	Merged logs keep the place of the first log they cover, so documents are still applied before the
+	later logs that link to them, and take the name and creation of the last one;
+	consumers of compacted pages only checkpoint at page ends, see SyncBatch
+	"""
+	groups = {}
+	for position, log in enumerate(update_logs):
+		key = (log.ref_doctype, log.docname)
+		pending = groups.get(key)
+		merged = merge_update_logs(pending[-1][1], log) if pending else None
+		if merged is False:
+			# cancelled out
+			pending.pop()
+		elif merged:
+			pending[-1] = (pending[-1][0], merged)
 		else:
-			result.append(d)
+			groups.setdefault(key, []).append((position, log))
 
-	for d in result:
-		mark_consumer_read(update_log_name=d.name, consumer_name=consumer.name)
+	compacted = sorted((entry for pending in groups.values() for entry in pending), key=lambda e: e[0])
+	return [log for _position, log in compacted]
+
+
+def merge_update_logs(first, second):
+	"""
+	Merge two logs of the same document
+	:return: the merged log, False if they cancel out, None if they can not be merged
+	"""
+	if second.update_type == "Delete":
+		if first.update_type == "Create":
+			return False
+		if first.update_type == "Update":
+			return second
+		return None
+
+	if second.update_type != "Update" or first.update_type not in ("Create", "Update"):
+		return None
+
+	diff = frappe._dict(frappe.parse_json(second.data))
+	if "docstatus" in (diff.changed or {}):
+		return None
+
+	merged = frappe._dict(first)
+	merged.name, merged.creation = second.name, second.creation
+	if first.update_type == "Create":
+		merged.data = frappe.as_json(apply_diff(frappe.parse_json(first.data), diff))
+	else:
+		merged.data = frappe.as_json(merge_diffs(frappe._dict(frappe.parse_json(first.data)), diff))
+	return merged
+
+
+def apply_diff(doc, diff):
+	"""Apply a get_update diff to a document dict"""
+	doc.update(diff.changed or {})
+	for tablename, names in (diff.removed or {}).items():
+		names = set(names)
+		doc[tablename] = [row for row in doc.get(tablename) or [] if row.get("name") not in names]
+	for tablename, rows in (diff.row_changed or {}).items():
+		rows_by_name = {row.get("name"): row for row in doc.get(tablename) or []}
+		for row in rows:
+			if row["name"] in rows_by_name:
+				rows_by_name[row["name"]].update(row)
+	for tablename, rows in (diff.added or {}).items():
+		doc.setdefault(tablename, []).extend(rows)
+	return doc
+
+
+def merge_diffs(first, second):
+	"""Combine two consecutive get_update diffs into one with the same effect"""
+	out = frappe._dict(
+		changed={**(first.changed or {}), **(second.changed or {})},
+		added={tablename: list(rows) for tablename, rows in (first.added or {}).items()},
+		removed={tablename: list(names) for tablename, names in (first.removed or {}).items()},
+		row_changed={
+			tablename: {row["name"]: dict(row) for row in rows}
+			for tablename, rows in (first.row_changed or {}).items()
+		},
+	)
+
+	for tablename, names in (second.removed or {}).items():
+		added = out.added.get(tablename, [])
+		added_names = {row.get("name") for row in added}
+		out.added[tablename] = [row for row in added if row.get("name") not in names]
+		for name in names:
+			out.row_changed.get(tablename, {}).pop(name, None)
+			# rows added in the first diff never reach the consumer
+			if name not in added_names:
+				out.removed.setdefault(tablename, []).append(name)
+
+	for tablename, rows in (second.row_changed or {}).items():
+		added_by_name = {row.get("name"): row for row in out.added.get(tablename, [])}
+		for row in rows:
+			if row["name"] in added_by_name:
+				added_by_name[row["name"]].update(row)
+			else:
+				out.row_changed.setdefault(tablename, {}).setdefault(row["name"], {}).update(row)
+
+	for tablename, rows in (second.added or {}).items():
+		out.added.setdefault(tablename, []).extend(rows)
+
+	out.row_changed = {tablename: list(rows.values()) for tablename, rows in out.row_changed.items()}
+	for key in ("added", "removed", "row_changed"):
+		out[key] = {tablename: rows for tablename, rows in out[key].items() if rows}
+	return out
+
+
+@frappe.whitelist()
+def get_update_logs_for_consumer(stream_consumer, doctypes, last_update):
+	"""
+	Fetches all the UpdateLogs for the consumer
+	Kept for consumers that do not paginate yet, reads the log table page by page
+	"""
+	result = []
+	last_name = None
+	while True:
+		page = get_update_log_page(stream_consumer, doctypes, last_update, last_name)
+		result.extend(page["updates"])
+		if not page["has_more"]:
+			break
+		last_update, last_name = page["last_update"], page["last_name"]
 
-	result.reverse()
 	return result
+
+
+def purge_update_logs():
+	"""
+	Scheduled daily, deletes the Update Logs older than the retention period
+	that every consumer has already pulled past
+	"""
+	settings = frappe.get_single("Stream Sync Settings")
+	if not settings.update_log_retention_days:
+		return
+
+	cutoff = add_days(now_datetime(), -settings.update_log_retention_days)
+	watermark = get_consumers_watermark()
+	if watermark:
+		cutoff = min(cutoff, watermark)
+	purge_logs("Stream Update Log", {"creation": ("<", cutoff)}, settings)
+
+
+def get_consumers_watermark():
+	"""Oldest cursor among consumers subscribed to any doctype, a consumer that never pulled counts from its registration"""
+	active = frappe.get_all(
+		"Stream Consumer Doctype",
+		filters={"status": "Actived", "unsubscribe": 0},
+		pluck="parent",
+		distinct=True,
+	)
+	if not active:
+		return None
+
+	consumers = frappe.get_all(
+		"Stream Consumer", filters={"name": ("in", active)}, fields=["creation", "last_update"]
+	)
+	return min((get_datetime(c.last_update or c.creation) for c in consumers), default=None)
+
+
+def on_doctype_update():
+	frappe.db.add_index("Stream Update Log", ["creation", "name"])
+	frappe.db.add_index("Stream Update Log", ["ref_doctype", "docname"])
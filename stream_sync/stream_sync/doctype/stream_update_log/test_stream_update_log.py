@@ -1,9 +1,82 @@
 # Copyright (c) 2025, Jufer and Contributors
 # See license.txt
 
-# import frappe
+import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from stream_sync.stream_sync.doctype.stream_update_log.stream_update_log import (
+	compact_update_logs,
+	merge_diffs,
+	merge_update_logs,
+)
+
+
+def make_log(name, update_type, docname, data, ref_doctype="ToDo"):
+	return frappe._dict(
+		name=name,
+		creation=f"2025-01-01 00:00:0{name[-1]}",
+		update_type=update_type,
+		ref_doctype=ref_doctype,
+		docname=docname,
+		data=frappe.as_json(data),
+	)
+
 
 class TestStreamUpdateLog(FrappeTestCase):
-	pass
+	def test_merge_diffs_drops_row_added_then_removed(self):
+		first = frappe._dict(added={"items": [{"name": "row-1", "qty": 1}]})
+		second = frappe._dict(removed={"items": ["row-1"]})
+
+		merged = merge_diffs(first, second)
+		self.assertEqual(merged.added, {})
+		self.assertEqual(merged.removed, {})
+
+	def test_merge_diffs_row_changed_on_added_row(self):
+		first = frappe._dict(added={"items": [{"name": "row-1", "qty": 1}]})
+		second = frappe._dict(row_changed={"items": [{"name": "row-1", "qty": 2}]})
+
+		merged = merge_diffs(first, second)
+		self.assertEqual(merged.added, {"items": [{"name": "row-1", "qty": 2}]})
+		self.assertEqual(merged.row_changed, {})
+
+	def test_merge_diffs_keeps_removal_of_existing_row(self):
+		first = frappe._dict(row_changed={"items": [{"name": "row-1", "qty": 2}]}, changed={"status": "Open"})
+		second = frappe._dict(removed={"items": ["row-1"]}, changed={"status": "Closed"})
+
+		merged = merge_diffs(first, second)
+		self.assertEqual(merged.removed, {"items": ["row-1"]})
+		self.assertEqual(merged.row_changed, {})
+		self.assertEqual(merged.changed, {"status": "Closed"})
+
+	def test_compact_create_update_delete_cancels_out(self):
+		logs = [
+			make_log("log-1", "Create", "A", {"doctype": "ToDo", "name": "A", "status": "Open"}),
+			make_log("log-2", "Create", "B", {"doctype": "ToDo", "name": "B", "status": "Open"}),
+			make_log("log-3", "Update", "A", {"changed": {"status": "Closed"}}),
+			make_log("log-4", "Delete", "A", {}),
+		]
+
+		self.assertEqual([log.name for log in compact_update_logs(logs)], ["log-2"])
+
+	def test_compact_create_update_keeps_first_position(self):
+		logs = [
+			make_log("log-1", "Create", "C", {"doctype": "Customer", "name": "C", "customer_group": "A"}),
+			make_log("log-2", "Create", "SO", {"doctype": "Sales Order", "name": "SO", "customer": "C"}),
+			make_log("log-3", "Update", "C", {"changed": {"customer_group": "B"}}),
+		]
+
+		compacted = compact_update_logs(logs)
+		self.assertEqual([log.docname for log in compacted], ["C", "SO"])
+		self.assertEqual(compacted[0].name, "log-3")
+		self.assertEqual(compacted[0].update_type, "Create")
+		self.assertEqual(frappe.parse_json(compacted[0].data).customer_group, "B")
+
+	def test_compact_keeps_docstatus_changes_apart(self):
+		logs = [
+			make_log("log-1", "Create", "A", {"doctype": "ToDo", "name": "A", "docstatus": 0}),
+			make_log("log-2", "Update", "A", {"changed": {"docstatus": 1}}),
+			make_log("log-3", "Update", "A", {"changed": {"docstatus": 2}}),
+		]
+
+		self.assertIsNone(merge_update_logs(logs[1], logs[2]))
+		self.assertEqual([log.name for log in compact_update_logs(logs)], ["log-1", "log-2", "log-3"])
@@ -1,9 +0,0 @@
-# Copyright (c) 2025, Jufer and contributors
-# For license information, please see license.txt
-
-# import frappe
-from frappe.model.document import Document
-
-
-class StreamUpdateLogConsumer(Document):
-	pass
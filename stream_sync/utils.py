@@ -0,0 +1,334 @@
+import base64
+import gzip
+import hashlib
+import math
+import os
+import zlib
+from urllib.parse import urlparse
+
+import frappe
+from frappe.frappeclient import FrappeClient
+from frappe.utils import cint, nowdate
+from requests.adapters import HTTPAdapter
+
+REMOTE_CLIENTS_VERSION_KEY = "stream_sync_remote_clients_version"
+
+# requests sent per get_docs call, the producer accepts up to MAX_DOC_REQUESTS
+DOC_REQUESTS_PER_CALL = 200
+
+# BenchSite per site name, None for sites that are not on this bench, see get_bench_site
+bench_sites = {}
+
+# FrappeClients shared by the whole process, keyed by (site, doctype, name), see get_remote_client
+remote_clients = {}
+
+
+def get_cache_version(key):
+	"""
+	Token shared by all processes of the site that changes on every bump_cache_version(key)
+	Process-local caches store it next to their data and rebuild when it no longer matches
+	"""
+	version = frappe.cache().get_value(key)
+	if not version:
+		version = bump_cache_version(key)
+	return version
+
+
+def bump_cache_version(key):
+	version = frappe.generate_hash(length=12)
+	frappe.cache().set_value(key, version)
+	return version
+
+
+def debounce(key, ttl):
+	"""
+	Claim the key for ttl seconds with an atomic SET NX
+	Returns True for the first caller only, until the claim is released or expires
+	"""
+	return bool(frappe.cache().set(frappe.cache().make_key(key), 1, nx=True, ex=ttl))
+
+
+def refresh_debounce(key, ttl):
+	"""Extend a claim taken with debounce for another ttl seconds, a released claim stays released"""
+	return bool(frappe.cache().expire(frappe.cache().make_key(key), ttl))
+
+
+def release_debounce(key):
+	"""
+	Release a claim taken with debounce, call it when the debounced job starts
+	Returns whether the claim was held
+	"""
+	return bool(frappe.cache().delete(frappe.cache().make_key(key)))
+
+
+def purge_logs(doctype, filters, settings):
+	"""
+	Delete the logs matching filters oldest first, purge_batch_size rows per transaction
+	so a large backlog never holds long locks, archiving each chunk first when enabled
+	"""
+	batch_size = cint(settings.purge_batch_size) or 1000
+	fields = ["*"] if settings.archive_logs else ["name"]
+	while True:
+		logs = frappe.get_all(
+			doctype, filters=filters, fields=fields, order_by="creation asc", limit=batch_size
+		)
+		if not logs:
+			break
+		if settings.archive_logs:
+			archive_logs(doctype, logs, settings.archive_folder)
+		frappe.db.delete(doctype, {"name": ("in", [log.name for log in logs])})
+		frappe.db.commit()
+		if len(logs) < batch_size:
+			break
+
+
+def archive_logs(doctype, logs, folder):
+	"""Append the logs as JSON lines to a gzipped file per doctype and day in the site's private folder"""
+	path = frappe.get_site_path("private", folder or "stream_sync_archive")
+	os.makedirs(path, exist_ok=True)
+	filename = os.path.join(path, f"{frappe.scrub(doctype)}-{nowdate()}.jsonl.gz")
+	# every append adds a gzip member, gzip readers handle the concatenated stream
+	with gzip.open(filename, "at", encoding="utf-8") as f:
+		for log in logs:
+			f.write(frappe.as_json(log, indent=None) + "\n")
+
+
+def get_remote_client(doctype, name):
+	"""
+	FrappeClient for the site of a Stream Producer or Stream Consumer, reused across calls in the process
+	Its session keeps pooled keep-alive connections to the remote site and applies the timeouts
+	from Stream Sync Settings; all clients are rebuilt after bump_cache_version(REMOTE_CLIENTS_VERSION_KEY)
+	"""
+	version = get_cache_version(REMOTE_CLIENTS_VERSION_KEY)
+	key = (frappe.local.site, doctype, name)
+	cached = remote_clients.get(key)
+	if cached and cached[0] == version:
+		return cached[1]
+
+	doc = frappe.get_doc(doctype, name)
+	client = FrappeClient(url=name, api_key=doc.api_key, api_secret=doc.get_password("api_secret"))
+
+	settings = frappe.get_cached_doc("Stream Sync Settings")
+	adapter = TimeoutHTTPAdapter(
+		timeout=(cint(settings.connect_timeout) or None, cint(settings.read_timeout) or None),
+		pool_maxsize=cint(settings.connection_pool_size) or 10,
+	)
+	client.session.mount("http://", adapter)
+	client.session.mount("https://", adapter)
+
+	remote_clients[key] = (version, client)
+	return client
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+	"""HTTPAdapter applying a default timeout, FrappeClient does not pass one"""
+
+	def __init__(self, timeout=None, **kwargs):
+		self.timeout = timeout
+		super().__init__(**kwargs)
+
+	def send(self, request, **kwargs):
+		if kwargs.get("timeout") is None:
+			kwargs["timeout"] = self.timeout
+		return super().send(request, **kwargs)
+
+
+def get_remote_docs(remote_site, requests):
+	"""
+	Resolve document requests on a remote site with stream_consumer.get_docs, in as few calls as possible
+	See get_docs for the request format, results come back in request order
+	"""
+	results = []
+	for i in range(0, len(requests), DOC_REQUESTS_PER_CALL):
+		results.extend(
+			remote_site.post_request(
+				{
+					"cmd": "stream_sync.stream_sync.doctype.stream_consumer.stream_consumer.get_docs",
+					"requests": frappe.as_json(requests[i : i + DOC_REQUESTS_PER_CALL]),
+				}
+			)
+		)
+	return results
+
+
+def get_bench_site(site_url):
+	"""
+	BenchSite reading the database of the site at site_url when it is a MariaDB site of this bench, else None
+	Kept for the life of the process so its connection is reused across pulls
+	"""
+	site_name = urlparse(site_url).hostname or site_url.strip("/")
+	if site_name == frappe.local.site:
+		return None
+
+	if site_name not in bench_sites:
+		site_path = os.path.join(frappe.local.sites_path, site_name)
+		bench_sites[site_name] = None
+		if os.path.exists(os.path.join(site_path, "site_config.json")):
+			conf = frappe.get_site_config(sites_path=frappe.local.sites_path, site_path=site_path)
+			if (conf.db_type or "mariadb") == "mariadb":
+				bench_sites[site_name] = BenchSite(site_name, conf)
+	return bench_sites[site_name]
+
+
+class BenchSite:
+	"""
+	Read-only connection to the database of another site of this bench, a plain PyMySQL connection
+	in autocommit mode so reads never touch frappe.db or the request state of the site being synced
+	Both sites run the same apps, so the local meta describes its tables
+	"""
+
+	def __init__(self, site_name, conf):
+		self.site_name = site_name
+		self.conf = conf
+		self.conn = None
+
+	def connect(self):
+		import pymysql
+		from pymysql.cursors import DictCursor
+
+		conf = self.conf
+		return pymysql.connect(
+			host=conf.db_host or "127.0.0.1",
+			port=cint(conf.db_port) or 3306,
+			unix_socket=conf.db_socket,
+			user=conf.db_user or conf.db_name,
+			password=conf.db_password,
+			database=conf.db_name,
+			charset="utf8mb4",
+			cursorclass=DictCursor,
+			# every read sees a fresh snapshot
+			autocommit=True,
+		)
+
+	def sql(self, query, values=None):
+		"""Run a read, reconnecting first when the connection was dropped"""
+		if self.conn is None:
+			self.conn = self.connect()
+		else:
+			self.conn.ping(reconnect=True)
+		with self.conn.cursor() as cursor:
+			cursor.execute(query, values)
+			return [frappe._dict(row) for row in cursor.fetchall()]
+
+	def get_rows(self, doctype, names):
+		"""Rows of the doctype by name"""
+		if not names:
+			return {}
+		rows = self.sql(f"select * from `tab{doctype}` where name in %(names)s", {"names": tuple(names)})
+		return {row.name: row for row in rows}
+
+	def get_docs(self, doctype, names):
+		"""Whole documents by name with their child rows, keyed by (doctype, name) like PullCache.remote"""
+		docs = self.get_rows(doctype, names)
+		if not docs:
+			return {}
+
+		for df in frappe.get_meta(doctype).get_table_fields():
+			for doc in docs.values():
+				doc[df.fieldname] = []
+			rows = self.sql(
+				f"""select * from `tab{df.options}`
+				where parent in %(names)s and parenttype=%(doctype)s and parentfield=%(fieldname)s
+				order by idx""",
+				{"names": tuple(docs), "doctype": doctype, "fieldname": df.fieldname},
+			)
+			for row in rows:
+				docs[row.parent][df.fieldname].append(row)
+
+		for doc in docs.values():
+			doc.doctype = doctype
+		return {(doctype, name): doc for name, doc in docs.items()}
+
+
+def get_links(doctype, values):
+	"""(doctype, name) of the documents linked by the values of a document of the doctype, child rows included"""
+	try:
+		meta = frappe.get_meta(doctype)
+	except frappe.DoesNotExistError:
+		return set()
+
+	links = set()
+	for df in meta.get_link_fields():
+		if values.get(df.fieldname):
+			links.add((df.get_link_doctype(), values.get(df.fieldname)))
+	for df in meta.get_dynamic_link_fields():
+		if values.get(df.fieldname) and values.get(df.options):
+			links.add((values.get(df.options), values.get(df.fieldname)))
+	for df in meta.get_table_fields():
+		for row in values.get(df.fieldname) or []:
+			links.update(get_links(df.options, row))
+	return links
+
+
+def get_update_links(doctype, update_type, data):
+	"""
+	(doctype, name) of the documents linked by the decoded data of an update,
+	the whole document for a Create, the changed values and rows for an Update
+	"""
+	if update_type == "Create":
+		return get_links(doctype, data)
+	if update_type != "Update":
+		return set()
+
+	data = frappe._dict(data)
+	meta = frappe.get_meta(doctype)
+	links = get_links(doctype, data.changed or {})
+	for rows in (data.added or {}, data.row_changed or {}):
+		for tablename, entries in rows.items():
+			# changed rows only carry their name and changed values
+			df = meta.get_field(tablename)
+			if not df or not df.options:
+				continue
+			for row in entries:
+				links.update(get_links(df.options, row))
+	return links
+
+
+def get_link_doctypes(doctype):
+	"""Doctypes the Link fields of the doctype and of its child tables point to"""
+	meta = frappe.get_meta(doctype)
+	doctypes = {df.get_link_doctype() for df in meta.get_link_fields()}
+	for df in meta.get_table_fields():
+		doctypes.update(df.get_link_doctype() for df in frappe.get_meta(df.options).get_link_fields())
+	return doctypes
+
+
+class NameDigest:
+	"""
+	Bloom filter over (doctype, name) pairs, tells the producer which masters the consumer holds in a few bytes per name
+	A false positive makes the producer leave out a master the consumer then fetches on demand
+	"""
+
+	def __init__(self, size, hashes, bits=None):
+		self.size = size
+		self.hashes = hashes
+		self.bits = bits or bytearray((size + 7) // 8)
+
+	@classmethod
+	def for_capacity(cls, capacity, error_rate=0.01):
+		size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+		return cls(size, max(1, round(size / max(capacity, 1) * math.log(2))))
+
+	def positions(self, doctype, name):
+		digest = hashlib.blake2b(f"{doctype}\0{name}".encode(), digest_size=16).digest()
+		first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+		return ((first + i * second) % self.size for i in range(self.hashes))
+
+	def add(self, doctype, name):
+		for position in self.positions(doctype, name):
+			self.bits[position >> 3] |= 1 << (position & 7)
+
+	def __contains__(self, key):
+		return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(*key))
+
+	def dumps(self):
+		return {
+			"size": self.size,
+			"hashes": self.hashes,
+			"bits": base64.b64encode(zlib.compress(bytes(self.bits))).decode(),
+		}
+
+	@classmethod
+	def loads(cls, data):
+		data = frappe.parse_json(data)
+		return cls(data["size"], data["hashes"], bytearray(zlib.decompress(base64.b64decode(data["bits"]))))